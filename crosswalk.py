@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import time
+from functools import lru_cache
+from os.path import join, exists
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from logging_config import log
+
+# The Chadwick register is parsed once and kept as a memory-mapped Arrow file, so every later process opens it
+# without reading the CSV. It's rebuilt from the register when it's older than MAX_AGE.
+DIRECTORY = join("data", "crosswalk")
+STORE = join(DIRECTORY, "chadwick.arrow")
+META = join(DIRECTORY, "chadwick.json")
+MAX_AGE = 7 * 24 * 60 * 60
+KEYS = ["key_mlbam", "key_fangraphs", "key_bbref", "key_retro"]
+INT_KEYS = ["key_mlbam", "key_fangraphs"]
+# Compact types, the numeric ids fit in int32 and use -1 for missing like chadwick_register does. REGISTER_TYPES are
+# the types chadwick_register returns.
+TYPES = {"key_mlbam": "int32", "key_fangraphs": "int32", "mlb_played_first": "float32", "mlb_played_last": "float32"}
+REGISTER_TYPES = {"key_mlbam": "int64", "key_fangraphs": "int64", "mlb_played_first": "float64",
+                  "mlb_played_last": "float64"}
+
+
+def build():
+    # pybaseball is only imported when the register has to be parsed
+    from pybaseball import chadwick_register
+    log.info("Building the player id crosswalk from the Chadwick register")
+    register = chadwick_register()
+    register = register.astype({column: dtype for column, dtype in TYPES.items() if column in register.columns})
+    table = pa.Table.from_pandas(register.reset_index(drop=True), preserve_index=False)
+    os.makedirs(DIRECTORY, exist_ok=True)
+    with pa.OSFile(STORE + ".tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    with open(META + ".tmp", "w") as f:
+        json.dump({"built": time.time(), "rows": len(register)}, f, indent=2)
+    os.replace(STORE + ".tmp", STORE)
+    os.replace(META + ".tmp", META)
+
+
+def stale():
+    if not exists(STORE) or not exists(META):
+        return True
+    with open(META, "r") as f:
+        return time.time() - json.load(f)["built"] > MAX_AGE
+
+
+class Crosswalk:
+    # Maps between the MLBAM, Fangraphs, Baseball Reference and Retrosheet ids, and from any of them to names. Every
+    # lookup takes an array of ids and is one hash lookup over all of them.
+
+    def __init__(self, table):
+        self.table = table
+        self.indexes = {}
+
+    def register(self):
+        # The register as chadwick_register() returns it, in its types
+        return self.table.astype({column: dtype for column, dtype in REGISTER_TYPES.items()
+                                  if column in self.table.columns})
+
+    def index(self, key):
+        # Each id points at its first row in the register, missing ids are left out
+        if key not in self.indexes:
+            ids = self.table[key]
+            valid = (ids != -1).to_numpy() if key in INT_KEYS else ids.notna().to_numpy()
+            positions = pd.Series(np.flatnonzero(valid), index=ids[valid].to_numpy())
+            self.indexes[key] = positions[~positions.index.duplicated()]
+        return self.indexes[key]
+
+    def rows(self, ids, key):
+        # Register row per id, -1 where the id isn't in the register
+        ids = pd.Series(np.asarray(ids))
+        if key in INT_KEYS:
+            ids = pd.to_numeric(ids, errors="coerce")
+        return ids.map(self.index(key)).fillna(-1).astype("int64").to_numpy()
+
+    def take(self, rows, column):
+        values = self.table[column].to_numpy()
+        found = rows >= 0
+        if column in INT_KEYS:
+            out = np.full(len(rows), -1, dtype="int64")
+        else:
+            out = np.full(len(rows), None if values.dtype == object else np.nan, dtype=values.dtype)
+        out[found] = values[rows[found]]
+        return out
+
+    def map(self, ids, key, to):
+        # ids given as "key" -> the matching "to" ids, -1 or missing where there's no match
+        return self.take(self.rows(ids, key), to)
+
+    def names(self, ids, key="key_mlbam"):
+        rows = self.rows(ids, key)
+        return pd.DataFrame({"name_first": self.take(rows, "name_first"), "name_last": self.take(rows, "name_last")})
+
+
+def load():
+    if stale():
+        build()
+    with pa.memory_map(STORE, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return Crosswalk(table.to_pandas())
+
+
+@lru_cache(maxsize=None)
+def get_crosswalk():
+    return load()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the player id crosswalk from the Chadwick register")
+    parser.add_argument("--refresh", action="store_true", help="Rebuild even if the crosswalk isn't stale")
+    args = parser.parse_args()
+    if args.refresh or stale():
+        build()
+    print("{} players in {}".format(len(get_crosswalk().table), STORE))
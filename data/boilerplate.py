@@ -1,33 +1,113 @@
 import datetime
 import hashlib
+import importlib
 import json
 from copy import copy
+from functools import lru_cache
 import pandas as pd
 import numpy as np
-from pybaseball import bwar_pitch, chadwick_register, fangraphs_teams, pitching, pitching_post, pitching_stats, \
-    pitching_stats_bref, pitching_stats_range, player_search_list, playerid_lookup, playerid_reverse_lookup, statcast, \
-    statcast_pitcher, team_pitching_bref, cache
-from pybaseball.statcast_pitcher import statcast_pitcher_exitvelo_barrels, statcast_pitcher_expected_stats, \
-    statcast_pitcher_pitch_arsenal, statcast_pitcher_pitch_movement, \
-    statcast_pitcher_percentile_ranks, statcast_pitcher_spin_dir_comp
 
-from pybaseball.statcast_pitcher import statcast_pitcher_arsenal_stats as sp_arsenal_stats
-from pybaseball.statcast_pitcher import statcast_pitcher_active_spin as sp_active_spin
 
-cache.enable()
+@lru_cache(maxsize=None)
+def load_pybaseball():
+    # Importing pybaseball takes over a second, so it's only imported the first time an endpoint is called
+    pybaseball = importlib.import_module("pybaseball")
+    pybaseball.cache.enable()
+    return pybaseball
+
+
+class Endpoint:
+    # A pybaseball function, imported when it's first called. The qualname is the name its tables are stored under,
+    # given up front so the tables are known without importing pybaseball.
+
+    def __init__(self, module, name, qualname=None):
+        self.module = module
+        self.name = name
+        self.__qualname__ = name if qualname is None else qualname
+
+    @property
+    def function(self):
+        load_pybaseball()
+        return getattr(importlib.import_module(self.module), self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
+
+    def __repr__(self):
+        return "Endpoint({})".format(self.__qualname__)
+
+
+bwar_pitch = Endpoint("pybaseball", "bwar_pitch")
+chadwick_register = Endpoint("pybaseball", "chadwick_register")
+fangraphs_teams = Endpoint("pybaseball", "fangraphs_teams", "team_ids")
+pitching = Endpoint("pybaseball", "pitching")
+pitching_post = Endpoint("pybaseball", "pitching_post")
+# The name data_types and the docs know the Fangraphs pitching table by
+pitching_stats = Endpoint("pybaseball", "pitching_stats", "FangraphsDataTable.fetch")
+pitching_stats_bref = Endpoint("pybaseball", "pitching_stats_bref")
+pitching_stats_range = Endpoint("pybaseball", "pitching_stats_range")
+player_search_list = Endpoint("pybaseball", "player_search_list")
+playerid_lookup = Endpoint("pybaseball", "playerid_lookup")
+playerid_reverse_lookup = Endpoint("pybaseball", "playerid_reverse_lookup")
+statcast = Endpoint("pybaseball", "statcast")
+statcast_pitcher = Endpoint("pybaseball", "statcast_pitcher")
+team_pitching_bref = Endpoint("pybaseball", "team_pitching_bref")
+statcast_pitcher_exitvelo_barrels = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_exitvelo_barrels")
+statcast_pitcher_expected_stats = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_expected_stats")
+statcast_pitcher_pitch_arsenal = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_pitch_arsenal")
+statcast_pitcher_pitch_movement = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_pitch_movement")
+statcast_pitcher_percentile_ranks = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_percentile_ranks")
+statcast_pitcher_spin_dir_comp = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_spin_dir_comp")
+sp_arsenal_stats = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_arsenal_stats")
+sp_active_spin = Endpoint("pybaseball.statcast_pitcher", "statcast_pitcher_active_spin")
 
 START_YEAR = 2000
 END_YEAR = datetime.date.today().year
 
-chadwick = chadwick_register()
 
-# Grab all players whos last year is during or after our start_year
-player_ids = set(pd.unique(chadwick[chadwick["mlb_played_last"].gt(START_YEAR - 1)]["key_mlbam"]))
+# The register and the id sets need network or cache loads, so they're only built the first time something asks for
+# them and then shared. "chadwick", "player_ids", "team_df" and "team_ids" still work as module attributes.
+@lru_cache(maxsize=None)
+def get_chadwick():
+    from crosswalk import get_crosswalk
+    return get_crosswalk().register()
+
+
+@lru_cache(maxsize=None)
+def get_player_ids():
+    # Grab all players whos last year is during or after our start_year
+    chadwick = get_chadwick()
+    return frozenset(pd.unique(chadwick[chadwick["mlb_played_last"].gt(START_YEAR - 1)]["key_mlbam"]))
+
+
+@lru_cache(maxsize=None)
+def get_team_df():
+    return pd.concat([fangraphs_teams(START_YEAR), fangraphs_teams(END_YEAR)])
+
+
+@lru_cache(maxsize=None)
+def get_team_ids():
+    # Not sure if all APIs take the teamID or franchID, so adding both to a set. If it's not used the API call should
+    # fail.
+    team_df = get_team_df()
+    team_ids = set(pd.unique(team_df["teamID"]))
+    team_ids.update(pd.unique(team_df["franchID"]))
+    return frozenset(team_ids)
+
+
+lazy_attributes = {
+    "chadwick": get_chadwick,
+    "player_ids": get_player_ids,
+    "team_df": get_team_df,
+    "team_ids": get_team_ids
+}
+
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        return lazy_attributes[name]()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-# Not sure if all APIs take the teamID or franchID, so adding both to a set. If it's not used the API call should fail.
-team_df = pd.concat([fangraphs_teams(START_YEAR), fangraphs_teams(END_YEAR)])
-team_ids = set(pd.unique(team_df["teamID"]))
-team_ids.update(pd.unique(team_df["franchID"]))
 
 # pitch_types = ['SL', 'CH', 'FC', 'FF', 'FS']
 pitch_types = ["FF", "SIFT", "CH", "CUKC", "FC", "SL", "FS"]
@@ -316,12 +396,20 @@ class YearIterator:
             raise StopIteration
 
 
+def season_window(year, since=None):
+    # The (start_dt, end_dt) strings for a season, starting at "since" when it falls inside that season
+    if since is not None and since.year == year:
+        return since.isoformat(), "{}-12-31".format(year)
+    return "{}-1-1".format(year), "{}-12-31".format(year)
+
+
 class StatcastIterator:
 
-    def __init__(self, start=START_YEAR, stop=END_YEAR, teams=team_ids):
-        self.teams = iter(teams)
-        self.current_team = next(self.teams)
-        self.start = start
+    def __init__(self, start=START_YEAR, stop=END_YEAR, teams=None, since=None):
+        self.team_list = teams
+        self.teams = None
+        self.since = since
+        self.start = start if since is None else max(start, since.year)
         self.stop = stop
         self.years = iter(list(range(self.start, self.stop + 1)))
 
@@ -329,15 +417,19 @@ class StatcastIterator:
         return self
 
     def __next__(self):
+        if self.teams is None:
+            self.teams = iter(self.team_list if self.team_list is not None else get_team_ids())
+            self.current_team = next(self.teams)
         try:
             year = next(self.years)
         except StopIteration:
             self.current_team = next(self.teams)
-            self.years = iter(list(range(START_YEAR, END_YEAR + 1)))
+            self.years = iter(list(range(self.start, self.stop + 1)))
             year = next(self.years)
+        start_dt, end_dt = season_window(year, self.since)
         return {
-            "start_dt": "{}-1-1".format(year),
-            "end_dt": "{}-12-31".format(year),
+            "start_dt": start_dt,
+            "end_dt": end_dt,
             "team": self.current_team,
             "verbose": False,
             "parallel": True
@@ -346,18 +438,23 @@ class StatcastIterator:
 
 class StatcastPitcherIterator:
 
-    def __init__(self, ids=player_ids, start=START_YEAR, end=END_YEAR):
-        self.player_ids = iter(ids)
+    def __init__(self, ids=None, start=START_YEAR, end=END_YEAR, since=None):
+        self.ids = ids
+        self.player_ids = None
         self.start = start
         self.end = end
+        self.since = since
 
     def __iter__(self):
         return self
 
     def __next__(self):
+        if self.player_ids is None:
+            self.player_ids = iter(self.ids if self.ids is not None else get_player_ids())
         pid = int(next(self.player_ids))
+        start_dt = "{}-1-1".format(self.start) if self.since is None else self.since.isoformat()
         return {
-            "start_dt": "{}-1-1".format(self.start),
+            "start_dt": start_dt,
             "end_dt": "{}-12-31".format(self.end),
             "player_id": pid
         }
@@ -385,17 +482,100 @@ class PitchingStatsIterator:
             raise StopIteration
 
 
+# Savant stops returning rows past this many per search
+ROW_CAP = 25000
+
+# Spring training through the end of the postseason, nothing is played outside of it
+SEASON_START = (2, 1)
+SEASON_END = (11, 30)
+
+
+def week_windows(year, since=None, days=7):
+    start = datetime.date(year, *SEASON_START)
+    end = min(datetime.date(year, *SEASON_END), datetime.date.today())
+    if since is not None:
+        start = max(start, since)
+    while start <= end:
+        stop = min(start + datetime.timedelta(days=days - 1), end)
+        yield start, stop
+        start = stop + datetime.timedelta(days=1)
+
+
+# Planners are iterators that can also react to responses. pull_data calls refine() to replace a truncated
+# response with smaller requests and split() to post-process a response. "method" overrides the API method called.
+class StatcastPlanner:
+
+    def __init__(self, start=START_YEAR, stop=END_YEAR, since=None, days=7, row_cap=ROW_CAP):
+        self.start = start if since is None else max(start, since.year)
+        self.stop = stop
+        self.since = since
+        self.days = days
+        self.row_cap = row_cap
+
+    def __iter__(self):
+        for year in range(self.start, self.stop + 1):
+            for start_dt, end_dt in week_windows(year, self.since, self.days):
+                yield self.request(start_dt, end_dt)
+
+    @staticmethod
+    def request(start_dt, end_dt):
+        return {
+            "start_dt": start_dt.isoformat(),
+            "end_dt": end_dt.isoformat(),
+            "verbose": False,
+            "parallel": True
+        }
+
+    def truncated(self, df):
+        # statcast() already stitches together daily searches, so a capped day is the tell
+        if len(df) >= self.row_cap and "game_date" in df.columns:
+            return df.groupby("game_date").size().max() >= self.row_cap or len(df) == self.row_cap
+        return len(df) == self.row_cap
+
+    def refine(self, d, df):
+        start_dt = datetime.date.fromisoformat(d["start_dt"])
+        end_dt = datetime.date.fromisoformat(d["end_dt"])
+        if not self.truncated(df) or start_dt == end_dt:
+            return None
+        middle = start_dt + (end_dt - start_dt) // 2
+        return [self.request(start_dt, middle), self.request(middle + datetime.timedelta(days=1), end_dt)]
+
+    def split(self, d, df):
+        return df
+
+
+class StatcastPitcherPlanner(StatcastPlanner):
+    # Serves the per-pitcher table from league-wide windows, which are the same requests StatcastPlanner makes
+    # and so usually come straight out of the cache. Rows are cut down to the pitchers we asked for locally.
+    method = staticmethod(statcast)
+
+    def __init__(self, ids=None, **kwargs):
+        super().__init__(**kwargs)
+        self.id_list = ids
+        self.ids = None
+
+    def split(self, d, df):
+        if self.ids is None:
+            ids = self.id_list if self.id_list is not None else get_player_ids()
+            self.ids = np.array(sorted(int(i) for i in ids))
+        df = df[df["pitcher"].isin(self.ids)]
+        return df.sort_values("pitcher", kind="stable")
+
+
 class TeamPitchingIterator:
 
-    def __init__(self, teams=team_ids):
-        self.teams = iter(teams)
-        self.current_team = next(self.teams)
+    def __init__(self, teams=None):
+        self.team_list = teams
+        self.teams = None
         self.years = iter(list(range(START_YEAR, END_YEAR + 1)))
 
     def __iter__(self):
         return self
 
     def __next__(self):
+        if self.teams is None:
+            self.teams = iter(self.team_list if self.team_list is not None else get_team_ids())
+            self.current_team = next(self.teams)
         try:
             year = next(self.years)
         except StopIteration:
@@ -455,8 +635,8 @@ api_methods = {
         "season": None,
         "league": "ALL"
     }],
-    statcast: StatcastIterator(),
-    statcast_pitcher: StatcastPitcherIterator(),
+    statcast: StatcastPlanner(),
+    statcast_pitcher: StatcastPitcherPlanner(),
     pitching_stats_bref: YearIterator(keys=["season"], start=2008),
     pitching_stats_range: PitchingStatsIterator(start=2008),
     bwar_pitch: [{
@@ -476,6 +656,59 @@ api_methods = {
     statcast_pitcher_spin_dir_comp: YearIterator(keys=["year"])
 }
 
+# Methods that can be refreshed incrementally: the column holding the game date and a factory for the iterator
+# that only covers games on or after a given date.
+incremental_methods = {
+    statcast.__qualname__: ("game_date", lambda since: StatcastPlanner(since=since)),
+    statcast_pitcher.__qualname__: ("game_date", lambda since: StatcastPitcherPlanner(since=since))
+}
+
+# The columns that identify a row of tables pulled in overlapping requests. Raw rows repeating a key are dropped.
+dedup_keys = {
+    statcast.__qualname__: ["game_pk", "at_bat_number", "pitch_number"],
+    statcast_pitcher.__qualname__: ["game_pk", "at_bat_number", "pitch_number"]
+}
+
+# Tables derived from another raw table instead of being requested: the source table and the column rows are sorted
+# on. Every statcast pitch already names its pitcher, so the per-pitcher table is the league-wide pitches ordered by
+# pitcher and doesn't need a request of its own.
+derived_methods = {
+    statcast_pitcher.__qualname__: (statcast.__qualname__, "pitcher")
+}
+
+# Pitch level tables are built in compact mode: readers get categoricals for low cardinality text, the smallest int
+# that fits each column's range and float32 for the float columns it holds exactly.
+compact_methods = {statcast.__qualname__, statcast_pitcher.__qualname__}
+
+# Which site serves each API method. Used to apply per-source concurrency and rate limits when pulling.
+api_sources = {
+    statcast.__qualname__: "savant",
+    statcast_pitcher.__qualname__: "savant",
+    statcast_pitcher_exitvelo_barrels.__qualname__: "savant",
+    statcast_pitcher_expected_stats.__qualname__: "savant",
+    statcast_pitcher_pitch_arsenal.__qualname__: "savant",
+    statcast_pitcher_arsenal_stats.__qualname__: "savant",
+    statcast_pitcher_pitch_movement.__qualname__: "savant",
+    statcast_pitcher_active_spin.__qualname__: "savant",
+    statcast_pitcher_percentile_ranks.__qualname__: "savant",
+    statcast_pitcher_spin_dir_comp.__qualname__: "savant",
+    pitching_stats.__qualname__: "fangraphs",
+    fangraphs_teams.__qualname__: "fangraphs",
+    pitching_stats_bref.__qualname__: "bref",
+    pitching_stats_range.__qualname__: "bref",
+    team_pitching_bref.__qualname__: "bref",
+    bwar_pitch.__qualname__: "bref"
+}
+
+# (max concurrent requests, minimum seconds between request starts) for each source.
+# Baseball-Reference blocks clients that go over ~20 requests a minute.
+source_limits = {
+    "savant": (4, 0.5),
+    "fangraphs": (2, 1.0),
+    "bref": (1, 3.5),
+    "other": (4, 0.0)
+}
+
 
 def copy_year(column):
     def inner_copy_year(df):
@@ -489,22 +722,28 @@ def chadwick_cleanup(df):
     return df.dropna(subset=['mlb_played_first', 'mlb_played_last']).astype({"mlb_played_first": pd.Int64Dtype(), "mlb_played_first": pd.Int64Dtype()})
 
 
+# The column each method reports its season in. Raw tables are partitioned on it and cleanup copies it into a
+# consistent "year" column, which build tables are partitioned on.
+year_columns = {
+    fangraphs_teams.__qualname__: "yearID",
+    statcast.__qualname__: "game_year",
+    statcast_pitcher.__qualname__: "game_year",
+    bwar_pitch.__qualname__: "year_ID",
+    pitching_stats.__qualname__: "Season",
+    team_pitching_bref.__qualname__: "Year",
+    pitching.__qualname__: "yearID",
+    pitching_post.__qualname__: "yearID",
+    statcast_pitcher_expected_stats.__qualname__: "year",
+    statcast_pitcher_pitch_movement.__qualname__: "year",
+    statcast_pitcher_percentile_ranks.__qualname__: "year",
+    statcast_pitcher_spin_dir_comp.__qualname__: "year"
+}
+
 # We want to introduce a consistent year column. Also a hook for any other cleanup.
 cleanup_methods = {
     playerid_reverse_lookup.__qualname__: chadwick_cleanup,
     player_search_list.__qualname__: chadwick_cleanup,
     playerid_lookup.__qualname__: chadwick_cleanup,
-    chadwick_register.__qualname__: chadwick_cleanup,
-    fangraphs_teams.__qualname__: copy_year("yearID"),
-    statcast.__qualname__: copy_year("game_year"),
-    statcast_pitcher.__qualname__: copy_year("game_year"),
-    bwar_pitch.__qualname__: copy_year("year_ID"),
-    pitching_stats.__qualname__: copy_year("Season"),
-    team_pitching_bref.__qualname__: copy_year("Year"),
-    pitching.__qualname__: copy_year("yearID"),
-    pitching_post.__qualname__: copy_year("yearID"),
-    statcast_pitcher_expected_stats.__qualname__: copy_year("year"),
-    statcast_pitcher_pitch_movement.__qualname__: copy_year("year"),
-    statcast_pitcher_percentile_ranks.__qualname__: copy_year("year"),
-    statcast_pitcher_spin_dir_comp.__qualname__: copy_year("year")
+    chadwick_register.__qualname__: chadwick_cleanup
 }
+cleanup_methods.update({method: copy_year(column) for method, column in year_columns.items()})
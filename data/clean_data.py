@@ -1,40 +1,183 @@
-import pickle
-import traceback
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-from boilerplate import cleanup_methods, data_types
-from glob import glob
-from os.path import join, basename, exists
+from boilerplate import cleanup_methods, compact_methods, data_types, incremental_methods
+from incremental import load_watermarks, save_watermark, since_mask, splice
 from logging_config import log
+from metrics import progress, stage
+from storage import append_table, begin_table, column_stats, commit_table, compact_table, exists_table, iter_partitions, \
+    list_tables, load_schema, merge_stats, partitions, read_table, save_schema, table_bytes, write_partition
 import pandas as pd
 from numpy import nan
+from pandas.api.types import is_object_dtype
 
 
-def main():
-    file_list = glob(join("data", "raw", "*.pkl"))
-    for file in file_list:
-        path = join("data", "build", basename(file))
-        if not exists(path):
-            log.info(file)
-            with open(file, "rb") as f:
-                df = pickle.load(f)
+@lru_cache(maxsize=None)
+def compile_plan(method, schema):
+    # Turns data_types into one list of steps per column for a given ((column, dtype), ...) schema. Only text
+    # columns get the blank check, and columns that already have their target dtype are left alone. The conversions
+    # are the same astype the whole frame used to get, so malformed values are handled the same way.
+    types = data_types.get(method, {})
+    plan = []
+    for column, dtype in schema:
+        steps = []
+        if dtype == "object" or dtype == "string":
+            steps.append(("blank", None))
+        target = types.get(column)
+        if target is not None and target != dtype:
+            steps.append(("astype", target))
+        if len(steps) > 0:
+            plan.append((column, tuple(steps)))
+    return tuple(plan)
 
-            method = basename(file).replace(".pkl", "")
 
-            if method in cleanup_methods:
-                log.info("Cleanup Methods")
-                df = cleanup_methods[method](df)
-            if method in data_types:
-                log.info("Datatype Methods")
-                data_type = data_types[method]
-                df = df.replace(r'^\s*$', nan, regex=True)
-                df = df.replace(pd.NA, nan)
-                df = df.astype(data_type)
+def blank_to_nan(series):
+    # Whitespace-only strings and pd.NA become nan, like a regex replace would but without scanning other columns
+    try:
+        blank = series.str.fullmatch(r"\s*")
+    except AttributeError:
+        blank = None
+    if blank is not None:
+        series = series.mask(blank.fillna(False).astype(bool), nan)
+    if is_object_dtype(series):
+        series = series.replace(pd.NA, nan)
+    return series
 
-            log.info(df.dtypes)
-            log.info("Saving...")
-            with open(path, "wb") as f:
-                pickle.dump(df, f)
+
+def run_step(series, step, target):
+    if step == "blank":
+        return blank_to_nan(series)
+    return series.astype(target)
+
+
+def clean(method, df):
+    if method in cleanup_methods:
+        log.info("Cleanup Methods")
+        df = cleanup_methods[method](df)
+    if method in data_types:
+        log.info("Datatype Methods")
+        schema = tuple((column, str(dtype)) for column, dtype in df.dtypes.items())
+        columns = {}
+        for column, steps in compile_plan(method, schema):
+            series = df[column]
+            for step, target in steps:
+                series = run_step(series, step, target)
+            columns[column] = series
+        df = df.assign(**columns) if len(columns) > 0 else df
+    return df
+
+
+def build_partition_by(df):
+    return "year" if "year" in df.columns else None
+
+
+def clean_partition(method, years, target):
+    # Runs in a worker process, so partitions come in and go out through the files rather than pickled frames.
+    # years is the one raw partition to clean, None for an unpartitioned table. Returns the rows read and written
+    # and the column stats a compact schema is chosen from.
+    log.info("{} - {}".format(method, years))
+    rows_in, rows_out, stats = 0, 0, {}
+    for _, df in iter_partitions("raw", method, years=years):
+        rows_in += len(df)
+        df = clean(method, df)
+        log.info(df.dtypes)
+        rows_out += len(df)
+        append_table("build", target, df, partition_by=build_partition_by(df))
+        if method in compact_methods:
+            stats = merge_stats(stats, column_stats(df))
+    return rows_in, rows_out, stats
+
+
+def clean_table(method, pool=None, s=None):
+    # Raw partitions are cleaned independently, on a process pool when one is given
+    target = begin_table("build", method)
+    # The __null__ partition is read on its own like every other season
+    parts = [None if column is None else [value] for column, value, _ in partitions("raw", method)]
+    if pool is None:
+        futures = [None] * len(parts)
+    else:
+        futures = [pool.submit(clean_partition, method, years, target) for years in parts]
+    stats = {}
+    for years, future in progress(list(zip(parts, futures)), "Cleaning {}".format(method)):
+        if future is None:
+            rows_in, rows_out, partition_stats = clean_partition(method, years, target)
+        else:
+            rows_in, rows_out, partition_stats = future.result()
+        stats = merge_stats(stats, partition_stats)
+        if s is not None:
+            s.add("rows_in", rows_in)
+            s.add("rows_out", rows_out)
+    commit_table("build", method)
+
+    if method in compact_methods:
+        compact_table("build", method, save_schema("build", method, stats))
+
+
+def refresh(method, since, s=None):
+    # Only clean the raw games on or after the build high-water mark and splice them into the build seasons
+    column = incremental_methods[method][0]
+    log.info("Refreshing {} from {}".format(method, since))
+    stats = load_schema("build", method)[1]
+    years = [value for _, value, _ in partitions("raw", method) if value is None or value >= since.year]
+    for _, df in iter_partitions("raw", method, years=years):
+        df = df[since_mask(df, column, since)]
+        if s is not None:
+            s.add("rows_in", len(df))
+        df = clean(method, df)
+        if s is not None:
+            s.add("rows_out", len(df))
+        if method in compact_methods:
+            stats = merge_stats(stats, column_stats(df))
+        for year, new in df.groupby("year", sort=True):
+            existing = read_table("build", method, years=[year], compact=False)
+            write_partition("build", method, splice(existing, new, column, since), "year", year)
+    if method in compact_methods:
+        compact_table("build", method, save_schema("build", method, stats))
+
+
+def build(method, pool=None, since=None):
+    # A full clean, or a splice of the games since the build high-water mark when one is given
+    with stage("clean_data", table=method, mode="full" if since is None else "refresh") as s:
+        if since is None:
+            log.info(method)
+            clean_table(method, pool, s)
+            s.add("bytes_read", table_bytes("raw", method))
+            s.add("bytes_written", table_bytes("build", method))
+        else:
+            refresh(method, since, s)
+    log.info("Saved {}".format(method))
+    raw_marks = load_watermarks("raw")
+    if method in raw_marks:
+        save_watermark("build", method, raw_marks[method])
+
+
+def stale_since(method):
+    # The build high-water mark if the raw table has newer games than the build table, otherwise None
+    raw_marks = load_watermarks("raw")
+    build_marks = load_watermarks("build")
+    if method in incremental_methods and method in build_marks and \
+            raw_marks.get(method, build_marks[method]) > build_marks[method]:
+        return build_marks[method]
+    return None
+
+
+def main(incremental=False, workers=None):
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+    for method in list_tables("raw"):
+        if not exists_table("build", method):
+            build(method, pool)
+        elif incremental and stale_since(method) is not None:
+            build(method, pool, stale_since(method))
+
+    if pool is not None:
+        pool.shutdown()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="Splice newly pulled games into existing build tables instead of skipping them")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, 1 cleans in this process")
+    args = parser.parse_args()
+    main(incremental=args.incremental, workers=args.workers)
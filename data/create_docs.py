@@ -1,15 +1,22 @@
+import argparse
 import inspect
+from concurrent.futures import ProcessPoolExecutor
 from logging_config import log
-from glob import glob
-from os.path import join, basename
+from os.path import join
+import numpy as np
 import pandas as pd
-from pandas import unique
-from pandas.api.types import is_numeric_dtype
-from numpy import max, min, mean, median, count_nonzero, std
+from pandas.api.types import is_bool_dtype, is_extension_array_dtype, is_integer_dtype, is_numeric_dtype
 from boilerplate import api_methods
-import pickle
+from storage import list_tables, iter_partitions
 import csv
 
+IGNORE = ["level_0", "index", "year"]
+ITEM_LIMIT = 50
+# Columns are profiled exactly up to this many values, beyond it the median comes from a uniform sample this size
+SAMPLE_SIZE = 200000
+# Distinct counts are sketched from the SKETCH_SIZE smallest value hashes
+SKETCH_SIZE = 1024
+
 
 def create_descriptions():
     out = {}
@@ -21,11 +28,6 @@ def create_descriptions():
     return out
 
 
-def read_df(file_name):
-    with open(file_name, "rb") as f:
-        return pickle.load(f)
-
-
 def find_method(name):
     for method in api_methods.keys():
         if method.__qualname__ == name:
@@ -33,74 +35,182 @@ def find_method(name):
     return None
 
 
-def nq(method, series):
-    if is_numeric_dtype(series):
-        try:
-            return method(series)
-        except TypeError:
-            pass
-    return None
-
-
-def unique(series):
-    u = pd.unique(series)
-    if len(u) > 50:
-        return None
+def bottom(keys, values, k):
+    # The k entries with the smallest keys, how both the median sample and the distinct sketch stay mergeable
+    if len(keys) <= k:
+        return keys, values
+    keep = np.argpartition(keys, k - 1)[:k]
+    return keys[keep], values[keep]
+
+
+class DistinctSketch:
+    # K minimum values sketch. Exact while fewer than k distinct hashes have been seen.
+
+    def __init__(self, k=SKETCH_SIZE):
+        self.k = k
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def update(self, series):
+        hashes = pd.util.hash_array(series.to_numpy(dtype=object, na_value=None))
+        hashes = np.unique(np.concatenate([self.hashes, hashes]))
+        self.hashes = hashes[:self.k]
+
+    def estimate(self):
+        if len(self.hashes) < self.k:
+            return len(self.hashes)
+        return int((self.k - 1) / (float(self.hashes[-1]) / 2 ** 64))
+
+
+class ColumnProfile:
+    # Mergeable accumulators for one column. Every statistic is updated from the same chunk of values.
+
+    def __init__(self, dtype, seed=0):
+        self.type = dtype.name
+        self.numeric = is_numeric_dtype(dtype)
+        self.integer = is_integer_dtype(dtype) and not is_bool_dtype(dtype)
+        self.masked = is_extension_array_dtype(dtype)
+        self.size = 0
+        self.missing = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.keys = np.empty(0)
+        self.sample = np.empty(0)
+        self.items = {}
+        self.sketch = None
+        self.first_year = None
+        self.last_year = None
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, series, years=None):
+        missing = series.isna().to_numpy()
+        self.size += len(series)
+        self.missing += int(missing.sum())
+
+        if self.numeric:
+            self.update_numeric(series.to_numpy(dtype=np.float64, na_value=np.nan)[~missing])
+        if self.items is not None:
+            self.update_items(series)
+        if years is not None:
+            present = years[~missing]
+            if len(present) > 0:
+                first, last = present.min(), present.max()
+                self.first_year = first if self.first_year is None else min(self.first_year, first)
+                self.last_year = last if self.last_year is None else max(self.last_year, last)
+
+    def update_numeric(self, values):
+        n = len(values)
+        if n == 0:
+            return
+        # Chan et al. parallel variance, the chunk's moments are folded into the running ones
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        # Every value gets a random key, keeping the smallest keys is a uniform sample of the whole column
+        self.keys, self.sample = bottom(np.concatenate([self.keys, self.rng.random(n)]),
+                                        np.concatenate([self.sample, values]), SAMPLE_SIZE)
+
+    def update_items(self, series):
+        # High cardinality columns are dropped from item tracking by the sketch before a full unique is needed
+        if self.sketch is None and len(series) > SAMPLE_SIZE:
+            self.sketch = DistinctSketch()
+        if self.sketch is not None:
+            self.sketch.update(series)
+            if self.sketch.estimate() > 2 * ITEM_LIMIT:
+                self.items = None
+                return
+        for item in pd.unique(series):
+            key = "nan" if pd.isna(item) else item
+            if key not in self.items:
+                self.items[key] = item
+        if len(self.items) > ITEM_LIMIT:
+            self.items = None
+
+    def stat(self, value):
+        if not self.numeric or self.count == 0:
+            return None if not self.numeric else np.nan
+        return int(value) if self.integer else value
+
+    def row(self, method_name, column, description):
+        numeric = self.numeric and self.count > 0
+        # np.median propagated missing values, so columns with any keep reporting nan. It raised on the pd.NA of
+        # nullable columns, which reported None.
+        median = None
+        if self.numeric and not (self.masked and (self.missing > 0 or self.count == 0)):
+            median = np.median(self.sample) if numeric and self.missing == 0 else np.nan
+        return [method_name, column, True, self.type,
+                self.stat(self.max), self.stat(self.min),
+                self.mean if numeric else (np.nan if self.numeric else None),
+                median,
+                np.sqrt(self.m2 / self.count) if numeric else (np.nan if self.numeric else None),
+                self.missing / self.size if self.size > 0 else np.nan,
+                self.first_year, self.last_year,
+                None if self.items is None else str(list(self.items.values())),
+                description]
+
+
+def profile(method_name, descriptions):
+    # One pass over the table, partition by partition, every column's accumulators fed from the same read
+    log.info(method_name)
+    method = find_method(method_name)
+    rows = []
+
+    # Add all the input rows
+    argspec = inspect.getfullargspec(getattr(method, "function", method))
+    for arg in argspec.args:
+        t = None if arg not in argspec.annotations else str(argspec.annotations[arg])
+        rows.append([method_name, arg, False, t, None, None, None, None, None, None, None, None, None])
+
+    # Add the output rows
+    profiles = {}
+    for _, df in iter_partitions("build", method_name, mmap=True, compact=False):
+        if df.size == 0:
+            continue
+        years = df["year"].to_numpy(dtype=np.float64, na_value=np.nan) if "year" in df.columns else None
+        for column in df.columns:
+            if column in IGNORE:
+                continue
+            if column not in profiles:
+                profiles[column] = ColumnProfile(df.dtypes[column], seed=len(profiles))
+            profiles[column].update(df[column], years)
+
+    for column, column_profile in profiles.items():
+        if column_profile.first_year is not None:
+            column_profile.first_year = int(column_profile.first_year)
+            column_profile.last_year = int(column_profile.last_year)
+        rows.append(column_profile.row(method.__qualname__, column, descriptions.get(column)))
+    return rows
+
+
+def main(workers=None):
+    descriptions = create_descriptions()
+    names = list_tables("build")
+    # Tables are profiled in parallel, rows are still written in table order
+    if workers == 1:
+        results = [profile(name, descriptions) for name in names]
     else:
-        return str(list(u))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(profile, names, [descriptions] * len(names)))
 
-
-def year(df, col):
-    if "year" not in df.columns:
-        return None, None
-
-    series = df[[col, "year"]]
-    years = series.dropna(subset=[col])["year"]
-    return years.min(), years.max()
-
-
-def main():
-    descriptions = create_descriptions()
     with open(join("data", "csv", "api.csv"), "w") as file:
         writer = csv.writer(file)
-        ignore = ["level_0", "index", "year"]
         fields = ["method", "parameter", "output", "type", "max", "min", "mean", "median", "std", "%nan", "first_year", "last_year", "items", "description"]
         writer.writerow(fields)
-
-        file_names = glob(join("data", "build", "*.pkl"))
-        for file_name in file_names:
-            rows = []
-            log.info(file_name)
-            method_name = basename(file_name).replace(".pkl", "")
-            method = find_method(method_name)
-            dataframe = read_df(file_name)
-
-            # Add all the input rows
-            argspec = inspect.getfullargspec(method)
-            for arg in argspec.args:
-                t = None if arg not in argspec.annotations else str(argspec.annotations[arg])
-                rows.append([method_name, arg, False, t, None, None, None, None, None, None, None, None, None])
-
-            # Add the output rows
-            if dataframe.size > 0:
-                for column in dataframe.columns:
-                    if column not in ignore:
-                        log.info(column)
-
-                        desc = None
-                        if column in descriptions:
-                            desc = descriptions[column]
-
-                        series = dataframe[column]
-                        t = dataframe.dtypes.loc[[column]].values[0].name
-                        yrange = year(dataframe, column)
-                        rows.append([method.__qualname__, column, True, t, nq(max, series), nq(min, series),
-                                     nq(mean, series), nq(median, series), nq(std, series), count_nonzero(series.isna()) / series.size,
-                                     yrange[0], yrange[1], unique(series), desc])
-
+        for rows in results:
             writer.writerows(rows)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, 1 profiles in this process")
+    args = parser.parse_args()
+    main(workers=args.workers)
     print("Done")
@@ -1,16 +1,163 @@
+import argparse
+import hashlib
+import json
+import os
 import tarfile
-from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from logging_config import log
+from os.path import join, exists, isdir, relpath
 import time
 
+DIRECTORIES = ["build", "cache", "csv", "raw"]
+SNAPSHOTS = join("data", "snapshots")
+CHUNK = 1 << 20
 
-def main():
-    path = join("data", "data-{}.tar.gz".format(int(time.time())))
-    with tarfile.open(path, "w:gz") as tar:
-        tar.add(join("data", "build"), arcname="build")
-        tar.add(join("data", "cache"), arcname="cache")
-        tar.add(join("data", "csv"), arcname="csv")
-        tar.add(join("data", "raw"), arcname="raw")
+
+# A snapshot is data/snapshots/{stamp}/ with a manifest.json and gzip tar shards. The manifest lists every file in
+# the snapshot with its sha256 and the snapshot and shard it is stored in, so unchanged files point back at the
+# shard of an earlier snapshot instead of being archived again.
+def snapshot_dir(stamp):
+    return join(SNAPSHOTS, str(stamp))
+
+
+def manifest_path(stamp):
+    return join(snapshot_dir(stamp), "manifest.json")
+
+
+def list_snapshots():
+    if not isdir(SNAPSHOTS):
+        return []
+    return sorted(int(name) for name in os.listdir(SNAPSHOTS) if exists(manifest_path(name)))
+
+
+def load_manifest(stamp):
+    with open(manifest_path(stamp), "r") as f:
+        return json.load(f)
+
+
+def list_files(root="data"):
+    # Half written tables are skipped, they are either swapped in or thrown away by the next run
+    files = []
+    for directory in DIRECTORIES:
+        for parent, dirs, names in os.walk(join(root, directory)):
+            dirs[:] = sorted(d for d in dirs if not d.endswith(".tmp"))
+            for name in sorted(names):
+                if not name.endswith(".tmp"):
+                    files.append(relpath(join(parent, name), root))
+    return files
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_files(files, previous, root="data", workers=8):
+    # hashlib drops the GIL on large updates, so files are hashed in threads. A file whose size and mtime match the
+    # previous manifest keeps its recorded hash without being read.
+    def entry(name):
+        stat = os.stat(join(root, name))
+        old = previous.get(name)
+        if old is not None and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+            return name, old["sha256"], stat
+        return name, sha256(join(root, name)), stat
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(entry, files))
+
+
+def plan_shards(files, sizes, shards):
+    # Largest first into the lightest shard, so the shards take about as long to compress and unpack
+    bins = [[] for _ in range(shards)]
+    weights = [0] * shards
+    for name in sorted(files, key=lambda n: sizes[n], reverse=True):
+        i = weights.index(min(weights))
+        bins[i].append(name)
+        weights[i] += sizes[name]
+    return [b for b in bins if len(b) > 0]
+
+
+def write_shard(path, files, root="data"):
+    # zlib releases the GIL while compressing, so every shard gets its own thread
+    with tarfile.open(path + ".tmp", "w:gz") as tar:
+        for name in files:
+            tar.add(join(root, name), arcname=name)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def main(shards=8, workers=8, full=False):
+    stamp = int(time.time())
+    parents = list_snapshots()
+    parent = None if full or len(parents) == 0 else parents[-1]
+    previous = {} if parent is None else load_manifest(parent)["files"]
+
+    hashed = hash_files(list_files(), previous, workers=workers)
+    changed = [name for name, digest, _ in hashed if name not in previous or previous[name]["sha256"] != digest]
+    log.info("{} files, {} changed since {}".format(len(hashed), len(changed), parent))
+
+    os.makedirs(snapshot_dir(stamp), exist_ok=True)
+    sizes = {name: stat.st_size for name, _, stat in hashed}
+    stored = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for i, names in enumerate(plan_shards(changed, sizes, shards)):
+            shard = "shard-{:03d}.tar.gz".format(i)
+            futures.append(pool.submit(write_shard, join(snapshot_dir(stamp), shard), names))
+            stored.update({name: shard for name in names})
+        for future in futures:
+            log.info("Wrote {}".format(future.result()))
+
+    files = {}
+    for name, digest, stat in hashed:
+        if name in stored:
+            files[name] = {"sha256": digest, "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                           "snapshot": stamp, "shard": stored[name]}
+        else:
+            files[name] = dict(previous[name], size=stat.st_size, mtime=stat.st_mtime_ns)
+
+    # The manifest goes last, a snapshot without one is unfinished and is never used as a parent
+    with open(manifest_path(stamp) + ".tmp", "w") as f:
+        json.dump({"created": stamp, "parent": parent, "files": files}, f, indent=1, sort_keys=True)
+    os.replace(manifest_path(stamp) + ".tmp", manifest_path(stamp))
+    return stamp
+
+
+def extract_shard(path, names, root):
+    with tarfile.open(path, "r:gz") as tar:
+        for member in tar:
+            if member.name in names:
+                tar.extract(member, root)
+    return path
+
+
+def restore(stamp=None, root="data", workers=8):
+    # Every file in the manifest is pulled out of whichever snapshot's shard holds it, shards unpack in parallel
+    if stamp is None:
+        stamp = list_snapshots()[-1]
+    files = load_manifest(stamp)["files"]
+    shards = {}
+    for name, entry in files.items():
+        shards.setdefault(join(snapshot_dir(entry["snapshot"]), entry["shard"]), set()).add(name)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path in pool.map(lambda item: extract_shard(item[0], item[1], root), shards.items()):
+            log.info("Restored {}".format(path))
+    return stamp
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--full", action="store_true", help="Archive every file instead of only the changed ones")
+    parser.add_argument("--restore", nargs="?", type=int, const=-1, default=None, metavar="SNAPSHOT",
+                        help="Unpack a snapshot into data, the latest one if no stamp is given")
+    args = parser.parse_args()
+    if args.restore is not None:
+        restore(None if args.restore == -1 else args.restore, workers=args.workers)
+    else:
+        main(shards=args.shards, workers=args.workers, full=args.full)
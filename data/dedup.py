@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from logging_config import log
+from storage import TableWriter, iter_partitions
+
+# Seen keys are kept as sorted runs and merged once there are this many, so adding a frame never re-sorts them all
+MAX_RUNS = 8
+
+
+def row_keys(df, columns):
+    # One uint64 per row, hashed column by column without building tuples
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+class Deduplicator:
+    # Drops rows whose key columns were already seen, within a frame or in any earlier frame. Only the 8 byte hashes
+    # of the keys are kept, about 100MB for every pitch statcast has.
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.runs = []
+        self.dropped = 0
+
+    def seen(self, keys):
+        hit = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            i = np.searchsorted(run, keys)
+            hit |= run[np.minimum(i, len(run) - 1)] == keys
+        return hit
+
+    def __call__(self, df):
+        if len(df) == 0 or any(c not in df.columns for c in self.columns):
+            return df
+        keys = row_keys(df, self.columns)
+        keep = ~pd.Series(keys).duplicated().to_numpy() & ~self.seen(keys)
+        if keep.any():
+            self.runs.append(np.sort(keys[keep]))
+        if len(self.runs) > MAX_RUNS:
+            self.runs = [np.sort(np.concatenate(self.runs))]
+        self.dropped += int(len(df) - keep.sum())
+        return df[keep] if not keep.all() else df
+
+
+def count_duplicates(stage, method, columns):
+    # Reads only the key columns, so a table without duplicates costs one cheap pass and no writes
+    dropped = 0
+    for _, df in iter_partitions(stage, method, columns=columns):
+        dedup = Deduplicator(columns)
+        dedup(df)
+        dropped += dedup.dropped
+    return dropped
+
+
+def dedup_table(stage, method, columns, partition_by=None):
+    # Rewrites a table without its duplicate rows, one partition at a time. A pitch can't show up in two seasons, so
+    # the seen keys only have to cover the partition being read. A table without duplicates is left untouched, so
+    # its files and fingerprints don't change. Returns the number of rows dropped.
+    if count_duplicates(stage, method, columns) == 0:
+        log.info("No duplicate rows in {}".format(method))
+        return 0
+    writer = TableWriter(stage, method, partition_by)
+    dropped = 0
+    for _, df in iter_partitions(stage, method):
+        dedup = Deduplicator(columns)
+        writer.write(dedup(df))
+        dropped += dedup.dropped
+    if not writer.close():
+        return 0
+    log.info("Dropped {} duplicate rows from {}".format(dropped, method))
+    return dropped
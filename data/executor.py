@@ -0,0 +1,158 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from boilerplate import api_sources, source_limits
+from logging_config import log
+from metrics import record
+from request_cache import RequestCache, ttl_for
+
+
+class RateLimiter:
+    # Caps the number of requests in flight and spaces out when they start.
+
+    def __init__(self, concurrency, interval):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_start = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.semaphore.release()
+
+
+class RequestExecutor:
+    # Runs (method, params) requests on a bounded thread pool. Cached responses are served from the request cache,
+    # misses go through the rate limiter of the source serving the method and are cached as soon as they finish.
+    # transport makes the actual call, replay swaps in a local stand-in, and recorder sees every response. Failed
+    # calls are retried with exponential backoff, on_failure is told about requests that failed every attempt.
+
+    def __init__(self, max_workers=8, limits=source_limits, report_every=30, cache=None, transport=None,
+                 recorder=None, retries=3, backoff=2.0, on_failure=None):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.on_failure = on_failure
+        self.transport = transport if transport is not None else lambda method, d: method(**d)
+        self.recorder = recorder
+        self.limiters = {source: RateLimiter(*limit) for source, limit in limits.items()}
+        self.report_every = report_every
+        self.cache = cache if cache is not None else RequestCache()
+        self.stats = {"done": 0, "failed": 0}
+        self.stats_lock = threading.Lock()
+        self.queue = deque()
+
+    def limiter(self, method):
+        return self.limiters[api_sources.get(method.__qualname__, "other")]
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def fetch(self, method, d):
+        # Every request is recorded to the metrics file with its latency, rows and whether the cache served it
+        started = time.perf_counter()
+        cache = "hit"
+        try:
+            df = self.cache.get(method, d)
+            if df is None:
+                cache = "miss"
+                df = self.call(method, d)
+        except Exception:
+            record("request", method=method.__qualname__, params=d, cache=cache, status="error",
+                   wall=time.perf_counter() - started)
+            raise
+        record("request", method=method.__qualname__, params=d, cache=cache, status="ok",
+               wall=time.perf_counter() - started, rows=None if df is None else len(df))
+        if self.recorder is not None:
+            self.recorder(method, d, df)
+        return df
+
+    def call(self, method, d):
+        log.info("Cache Miss: {} - {}".format(method.__qualname__, d))
+        for attempt in range(self.retries + 1):
+            try:
+                with self.limiter(method):
+                    df = self.transport(method, d)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                # Jitter keeps retries from the same window from hitting the source in lockstep
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                log.info("Retrying {} - {} in {:.1f}s: {!r}".format(method.__qualname__, d, delay, e))
+                time.sleep(delay)
+
+        path = self.cache.put(method, d, df, ttl=ttl_for(d))
+        log.info("Cached request to {}".format(path))
+        return df
+
+    def report(self, started):
+        elapsed = time.monotonic() - started
+        done = self.stats["done"]
+        log.info("Throughput: {} requests in {:.0f}s ({:.2f}/s) - {} failed, cache: {}".format(
+            done, elapsed, done / elapsed if elapsed > 0 else 0.0, self.stats["failed"], self.cache.report()))
+
+    def submit(self, key, method, d):
+        # Queue a follow-up request while run() is going, it's picked up ahead of the remaining requests
+        self.queue.append((key, method, d))
+
+    def next_request(self, requests):
+        if len(self.queue) > 0:
+            return self.queue.popleft()
+        return next(requests)
+
+    def run(self, requests):
+        # Takes (key, method, d) requests and yields (key, method, d, df) as they complete, df is None when the
+        # request failed. Only a few batches of requests are submitted at a time so huge iterators are never
+        # materialized.
+        requests = iter(requests)
+        window = self.max_workers * 4
+        started = last_report = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {}
+            exhausted = False
+            while True:
+                while len(pending) < window and (len(self.queue) > 0 or not exhausted):
+                    try:
+                        key, method, d = self.next_request(requests)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    log.info("Request: {} - {}".format(method.__qualname__, d))
+                    pending[pool.submit(self.fetch, method, d)] = (key, method, d)
+
+                if len(pending) == 0 and len(self.queue) == 0:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, method, d = pending.pop(future)
+                    try:
+                        df = future.result()
+                    except Exception as e:
+                        log.exception("Failed to get df: {} - {}".format(method.__qualname__, d))
+                        self.count("failed")
+                        if self.on_failure is not None:
+                            self.on_failure(key, method, d, e)
+                        df = None
+                    self.count("done")
+                    yield key, method, d, df
+
+                if time.monotonic() - last_report > self.report_every:
+                    self.report(started)
+                    last_report = time.monotonic()
+
+        self.report(started)
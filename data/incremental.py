@@ -0,0 +1,55 @@
+import datetime
+import json
+import os
+import tempfile
+from os.path import join, exists
+from threading import Lock
+
+import pandas as pd
+
+
+# High-water marks are the latest game date seen for each incremental method, one file per stage. Tables are built on
+# several threads at once, so updates to the file are serialized.
+lock = Lock()
+
+
+def watermarks_path(stage):
+    return join("data", stage, "watermarks.json")
+
+
+def load_watermarks(stage):
+    path = watermarks_path(stage)
+    if not exists(path):
+        return {}
+    with open(path, "r") as f:
+        return {method: datetime.date.fromisoformat(day) for method, day in json.load(f).items()}
+
+
+def save_watermark(stage, method, day):
+    with lock:
+        marks = load_watermarks(stage)
+        marks[method] = day
+        path = watermarks_path(stage)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix="watermarks.", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({m: d.isoformat() for m, d in marks.items()}, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+
+def high_water(df, column):
+    dates = pd.to_datetime(df[column], errors="coerce").dropna()
+    if len(dates) == 0:
+        return None
+    return dates.max().date()
+
+
+def since_mask(df, column, since):
+    return pd.to_datetime(df[column], errors="coerce") >= pd.Timestamp(since)
+
+
+def splice(existing, new, column, since):
+    # Games on or after "since" are replaced by the freshly pulled rows, the last day may have been partial
+    if column not in existing.columns:
+        return new.reset_index(drop=True)
+    existing = existing[~since_mask(existing, column, since)]
+    return pd.concat([existing, new], ignore_index=True)
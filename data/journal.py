@@ -0,0 +1,63 @@
+import json
+import os
+import time
+from os.path import join, exists
+
+from boilerplate import dmd5
+
+
+# Requests that still failed after their retries, one file per stage. pull_data --repair re-requests only these and
+# patches the responses into the raw tables.
+def journal_path(stage):
+    return join("data", stage, "failures.json")
+
+
+def load_failures(stage):
+    # Returns {"{table}_{dmd5(params)}": {"table", "method", "params", "error", "attempts", "failed_at"}}
+    path = journal_path(stage)
+    if not exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_failures(stage, failures):
+    os.makedirs(join("data", stage), exist_ok=True)
+    with open(journal_path(stage) + ".tmp", "w") as f:
+        # Params keep their order, the key of a failure is the hash of the params as they were requested
+        json.dump(failures, f, indent=2)
+    os.replace(journal_path(stage) + ".tmp", journal_path(stage))
+
+
+def failure_key(table, d):
+    return "{}_{}".format(table, dmd5(d))
+
+
+def record_failure(stage, table, method, d, error):
+    failures = load_failures(stage)
+    key = failure_key(table, d)
+    attempts = failures[key]["attempts"] + 1 if key in failures else 1
+    failures[key] = {"table": table, "method": method, "params": d, "error": error, "attempts": attempts,
+                     "failed_at": time.time()}
+    save_failures(stage, failures)
+
+
+def clear_failure(stage, table, d):
+    # Returns whether the request was journaled. Journals saved with sorted params are matched on the params.
+    failures = load_failures(stage)
+    key = failure_key(table, d)
+    if key not in failures:
+        key = next((k for k, entry in failures.items() if entry["table"] == table and entry["params"] == d), None)
+    if key is None:
+        return False
+    del failures[key]
+    save_failures(stage, failures)
+    return True
+
+
+def clear_table(stage, table):
+    # A full pull starts the table over, so its old failures no longer apply
+    failures = load_failures(stage)
+    kept = {key: entry for key, entry in failures.items() if entry["table"] != table}
+    if len(kept) != len(failures):
+        save_failures(stage, kept)
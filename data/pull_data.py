@@ -1,46 +1,300 @@
+import argparse
 import pandas as pd
-import pickle
-from boilerplate import api_methods, dmd5
+from boilerplate import api_methods, dedup_keys, derived_methods, incremental_methods, year_columns
+from dedup import Deduplicator, dedup_table
+from executor import RequestExecutor
+from incremental import load_watermarks, save_watermark, high_water, splice
+from journal import clear_failure, clear_table, load_failures, record_failure
 from logging_config import log
-from os.path import join, exists
+import metrics
+from replay import CACHE, RAW, Recorder, Replay, reset
+from request_cache import RequestCache
+from storage import TableWriter, append_table, exists_table, iter_partitions, write_partition, read_table, partitions, \
+    table_bytes
 
-import pybaseball
-chadwick = pybaseball.chadwick_register()
 
+def append_since(name, ret, since, stage="raw"):
+    # Only the seasons the new games fall in are rewritten, every other partition is left untouched
+    column = incremental_methods[name][0]
+    partition_by = year_columns[name]
+    for year, new in ret.groupby(partition_by, sort=True):
+        existing = read_table(stage, name, years=[year])
+        write_partition(stage, name, splice(existing, new, column, since), partition_by, year)
 
-def main():
+
+def patch(name, df, stage="raw"):
+    # Repaired rows are added as new parts next to the existing ones, no partition is rewritten. Rows the table
+    # already holds are dropped first.
+    partition_by = year_columns.get(name)
+    if name in dedup_keys:
+        years = None
+        if partition_by in df.columns:
+            years = [None if pd.isna(y) else int(y) for y in pd.unique(df[partition_by])]
+        dedup = Deduplicator(dedup_keys[name])
+        dedup(read_table(stage, name, columns=dedup_keys[name], years=years))
+        df = dedup(df)
+    append_table(stage, name, df, partition_by)
+    log.info("Patched {} rows into {}".format(len(df), name))
+
+
+class RawSink:
+    # Where the responses for one method end up. Full pulls stream every response straight into the raw table, so
+    # memory only ever holds one of them. Incremental refreshes are a few days of games and are spliced in at the end,
+    # repairs are patched into the existing table.
+
+    def __init__(self, method, since=None, stage="raw", repair=False):
+        self.name = method.__qualname__
+        self.since = since
+        self.stage = stage
+        self.repair = repair
+        self.frames = []
+        self.writer = TableWriter(stage, self.name, year_columns.get(self.name)) \
+            if since is None and not repair else None
+        self.dedup = Deduplicator(dedup_keys[self.name]) if self.name in dedup_keys else None
+        self.high_water = None
+
+    def add(self, df):
+        df = df.reset_index()
+        if self.dedup is not None:
+            df = self.dedup(df)
+        if self.name in incremental_methods:
+            day = high_water(df, incremental_methods[self.name][0])
+            if day is not None and (self.high_water is None or day > self.high_water):
+                self.high_water = day
+        if self.writer is not None:
+            self.writer.write(df)
+        else:
+            self.frames.append(df)
+
+    def close(self):
+        if self.writer is not None:
+            written = self.writer.close()
+        else:
+            written = sum(len(df) for df in self.frames) > 0
+            if written and self.repair:
+                patch(self.name, pd.concat(self.frames, ignore_index=True), self.stage)
+            elif written:
+                log.info("Appending games since {} to {}".format(self.since, self.name))
+                append_since(self.name, pd.concat(self.frames, ignore_index=True), self.since, self.stage)
+
+        if self.dedup is not None and self.dedup.dropped > 0:
+            log.info("Dropped {} duplicate rows from {}".format(self.dedup.dropped, self.name))
+        if not written:
+            log.info("No returns for {}".format(self.name))
+            return
+
+        log.info("Created {}".format(self.name))
+        if self.high_water is not None:
+            save_watermark(self.stage, self.name,
+                           max(self.high_water, load_watermarks(self.stage).get(self.name, self.high_water)))
+
+
+def stored_high_water(name, column, stage="raw"):
+    # The newest game is in the latest season, so partitions are read newest first until one has a date
+    years = sorted((value for _, value, _ in partitions(stage, name) if value is not None), reverse=True)
+    for year in years:
+        day = high_water(read_table(stage, name, columns=[column], years=[year]), column)
+        if day is not None:
+            return day
+    return high_water(read_table(stage, name, columns=[column]), column)
+
+
+def derive(name, stage="raw", since=None):
+    # Builds a derived table one source partition at a time. A refresh only rebuilds the seasons from "since" on.
+    source, sort_by = derived_methods[name]
+    partition_by = year_columns.get(name)
+    log.info("Deriving {} from {}".format(name, source))
+    if since is None:
+        writer = TableWriter(stage, name, partition_by)
+        for _, df in iter_partitions(stage, source):
+            writer.write(df.sort_values(sort_by, kind="stable"))
+        if not writer.close():
+            log.info("No rows in {} to derive {} from".format(source, name))
+            return
+    else:
+        years = [value for _, value, _ in partitions(stage, source) if value is None or value >= since.year]
+        for year, df in iter_partitions(stage, source, years=years):
+            write_partition(stage, name, df.sort_values(sort_by, kind="stable"), partition_by, year)
+
+    mark = load_watermarks(stage).get(source)
+    if mark is not None:
+        save_watermark(stage, name, mark)
+
+
+def plan_derived(jobs, derived=True, stage="raw"):
+    # Returns {name: since} for the derived tables to build, since is None for a full build
+    if not derived:
+        return {}
+    pulled = {method.__qualname__: since for method, (_, since) in jobs.items()}
+    out = {}
+    for name, (source, _) in derived_methods.items():
+        if not exists_table(stage, name):
+            out[name] = None
+        elif source in pulled:
+            out[name] = pulled[source]
+    return out
+
+
+def plan(incremental=False, stage="raw", derived=True):
+    # Returns {method: (iterable of request dicts, since)}. Since is None for full pulls. Derived tables aren't
+    # requested unless derived is False.
+    jobs = {}
+    watermarks = load_watermarks(stage)
     for method in api_methods.keys():
-        fpath = join("data", "raw", method.__qualname__ + ".pkl")
-        if not exists(fpath):
-            all_dataframes = []
-            for d in api_methods[method]:
-                log.info("Request: {} - {}".format(method.__qualname__, d))
-                try:
-                    path = join("data", "cache", "{}_{}.pkl".format(method.__qualname__, dmd5(d)))
-                    if exists(path):
-                        with open(path, "rb") as file:
-                            df = pickle.load(file)
-                    else:
-                        log.info("Cache Miss")
-                        df = method(**d)
-                        with open(path, "wb") as file:
-                            pickle.dump(df, file)
-                        log.info("Cached request to {}".format(path))
-                    all_dataframes.append(df)
-                except:
-                    log.exception("Failed to get df")
-
-            if len(all_dataframes) > 0:
-                log.info("Concatenating dataframes for {}".format(method.__qualname__))
-                ret = pd.concat(all_dataframes)
-                ret = ret.reset_index()
-                with open(fpath, "wb") as file:
-                    pickle.dump(ret, file)
-
-                log.info("Created {}".format(fpath))
-            else:
-                log.info("No returns for {}".format(method.__qualname__))
+        if derived and method.__qualname__ in derived_methods:
+            continue
+        if not exists_table(stage, method.__qualname__):
+            jobs[method] = (api_methods[method], None)
+        elif incremental and method.__qualname__ in incremental_methods:
+            column, iterator = incremental_methods[method.__qualname__]
+            since = watermarks.get(method.__qualname__)
+            if since is None:
+                since = stored_high_water(method.__qualname__, column, stage)
+            if since is not None:
+                log.info("Refreshing {} from {}".format(method.__qualname__, since))
+                jobs[method] = (iterator(since), since)
+    return jobs
+
+
+def dedup(stage="raw"):
+    # Drops the duplicate rows of raw tables pulled before they were deduplicated on the way in, then rebuilds the
+    # tables derived from them
+    for name, columns in dedup_keys.items():
+        if name in derived_methods or not exists_table(stage, name):
+            continue
+        if dedup_table(stage, name, columns, year_columns.get(name)) > 0:
+            for derived, (source, _) in derived_methods.items():
+                if source == name:
+                    derive(derived, stage)
+
+
+class Repair:
+    # Re-requests the journaled failures of one table. Everything else comes from the table's own planner, so
+    # truncated responses are still split and post-processed the same way.
+
+    def __init__(self, params, requests):
+        self.params = params
+        self.requests = requests
+
+    def __iter__(self):
+        return iter(self.requests)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["params"], name)
+
+
+def plan_repair(stage="raw"):
+    # Returns jobs like plan() does, holding only the failed requests of each table
+    methods = {method.__qualname__: method for method in api_methods.keys()}
+    requests = {}
+    for entry in load_failures(stage).values():
+        requests.setdefault(entry["table"], []).append(entry["params"])
+    jobs = {}
+    for table, params in requests.items():
+        log.info("Repairing {} failed requests for {}".format(len(params), table))
+        jobs[methods[table]] = (Repair(api_methods[methods[table]], params), None)
+    return jobs
+
+
+def main(max_workers=8, incremental=False, replay=None, record=False, derived=True, repair=False, deduplicate=False):
+    # With a Replay the pull is served from recorded fixtures into data/replay, with its own cache and raw tables.
+    # They're cleared first unless repairing, which re-requests the last replay's failures. record keeps every
+    # response as a fixture for later replays. repair only re-requests the journaled failures. deduplicate drops the
+    # duplicate rows of the stage's existing tables before pulling.
+    stage = "raw" if replay is None else RAW
+    if replay is not None and not repair:
+        reset()
+    if deduplicate:
+        dedup(stage)
+    jobs = plan_repair(stage) if repair else plan(incremental, stage, derived)
+    for method, (_, since) in jobs.items():
+        if since is None and not repair:
+            clear_table(stage, method.__qualname__)
+    if replay is not None and replay.row_cap is not None:
+        # Planners have to notice the replay's cap to split truncated windows
+        for params, _ in jobs.values():
+            if hasattr(params, "row_cap"):
+                params.row_cap = replay.row_cap
+    sinks = {method: RawSink(method, since, stage, repair) for method, (_, since) in jobs.items()}
+    submitted = {method: 0 for method in jobs}
+    finished = {method: 0 for method in jobs}
+    exhausted = set()
+    executor = RequestExecutor(max_workers=max_workers, cache=None if replay is None else RequestCache(CACHE),
+                               transport=replay, recorder=Recorder() if record else None,
+                               on_failure=lambda method, fetch, d, e: record_failure(
+                                   stage, method.__qualname__, fetch.__qualname__, d, repr(e)))
+
+    # Requests from every method are fed to the executor, each method is closed once all of its requests are back.
+    # Planners can swap in a different API method for their requests.
+    def requests():
+        for method, (params, _) in jobs.items():
+            fetch = getattr(params, "method", method)
+            for d in params:
+                submitted[method] += 1
+                yield method, fetch, d
+            exhausted.add(method)
+
+    with metrics.stage("pull_data", incremental=incremental, replay=replay is not None) as s:
+        for method, fetch, d, df in executor.run(requests()):
+            finished[method] += 1
+            params = jobs[method][0]
+            if df is not None and repair and not clear_failure(stage, method.__qualname__, d):
+                log.warning("Repaired {} - {} isn't in the journal".format(method.__qualname__, d))
+            if df is not None and hasattr(params, "refine"):
+                smaller = params.refine(d, df)
+                if smaller is not None:
+                    log.info("Truncated response for {} - {}, splitting into {}".format(method.__qualname__, d, smaller))
+                    for sd in smaller:
+                        submitted[method] += 1
+                        executor.submit(method, fetch, sd)
+                    continue
+                df = params.split(d, df)
+            if df is not None:
+                s.add("rows_out", len(df))
+                sinks[method].add(df)
+            if method in exhausted and finished[method] == submitted[method]:
+                sinks.pop(method).close()
+
+        for method in list(sinks.keys()):
+            sinks.pop(method).close()
+
+        if repair:
+            log.info("{} failures left in the journal".format(len(load_failures(stage))))
+
+        derivations = plan_derived(jobs, derived, stage)
+        for name, since in derivations.items():
+            derive(name, stage, since)
+
+        s.add("cache_hits", executor.cache.stats["hits"])
+        s.add("cache_misses", executor.cache.stats["misses"])
+        s.add("bytes_read", executor.cache.stats["bytes_read"])
+        written = [method.__qualname__ for method in jobs] + list(derivations)
+        s.add("bytes_written", sum(table_bytes(stage, name) for name in written))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only pull games since the last high-water mark for methods that support it")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--no-derive", action="store_true",
+                        help="Request derived tables such as statcast_pitcher instead of building them from statcast")
+    parser.add_argument("--repair", action="store_true",
+                        help="Only re-request the failures in the journal and patch them into the raw tables")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Drop duplicate rows from existing raw tables before pulling")
+    parser.add_argument("--record", action="store_true", help="Keep every response as a replay fixture")
+    parser.add_argument("--replay", action="store_true",
+                        help="Serve requests from recorded fixtures into data/replay instead of the live APIs")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds a replayed request takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the replay latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of replayed requests that fail")
+    parser.add_argument("--row-cap", type=int, default=None, help="Truncate replayed responses to this many rows")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    replay = None
+    if args.replay:
+        replay = Replay(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, row_cap=args.row_cap,
+                        seed=args.seed)
+    main(max_workers=args.workers, incremental=args.incremental, replay=replay, record=args.record,
+         derived=not args.no_derive, repair=args.repair, deduplicate=args.dedup)
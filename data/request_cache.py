@@ -0,0 +1,180 @@
+import json
+import lzma
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from os.path import join, exists, getsize
+
+import pandas as pd
+from pyarrow.lib import ArrowException
+
+from boilerplate import dmd5, END_YEAR
+from logging_config import log
+
+
+def ttl_for(d):
+    # Anything touching the current season can still change, so only trust it for a day
+    for value in d.values():
+        if value == END_YEAR or (isinstance(value, str) and value.startswith(str(END_YEAR))):
+            return 24 * 60 * 60
+    return None
+
+
+class RequestCache:
+    # API responses keyed by "{qualname}_{dmd5(params)}". Every entry is tracked in one sqlite index so a lookup
+    # never touches the filesystem on a miss. DataFrames are stored as zstd parquet, anything parquet can't
+    # represent (mixed object columns) falls back to an xz pickle. Least recently used entries are evicted once the
+    # cache grows past max_bytes.
+
+    def __init__(self, directory=join("data", "cache"), max_bytes=50 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "bytes_read": 0, "bytes_written": 0, "evictions": 0}
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(join(directory, "index.sqlite"), check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY, method TEXT, params TEXT, path TEXT, format TEXT, size INTEGER,
+            fetched_at REAL, accessed_at REAL, ttl REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self.db.commit()
+        # A running total of the entries' sizes, so a put doesn't have to add up the whole index
+        self.bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def key(method, d):
+        return "{}_{}".format(method.__qualname__, dmd5(d))
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def total_bytes(self):
+        with self.lock:
+            return self.bytes
+
+    def get(self, method, d):
+        # Returns the cached response or None on a miss
+        key = self.key(method, d)
+        with self.lock:
+            row = self.db.execute("SELECT path, format, size, fetched_at, ttl FROM entries WHERE key = ?",
+                                  (key,)).fetchone()
+
+        if row is None:
+            df = self.migrate(method, d)
+            if df is None:
+                self.count("misses")
+            return df
+
+        path, fmt, size, fetched_at, ttl = row
+        if ttl is not None and time.time() > fetched_at + ttl:
+            log.info("Cache entry expired: {}".format(key))
+            self.remove(key, path)
+            self.count("misses")
+            return None
+
+        try:
+            df = self.read(path, fmt)
+        except (OSError, EOFError, ArrowException, pickle.UnpicklingError):
+            log.exception("Unreadable cache entry {}, dropping it".format(key))
+            self.remove(key, path)
+            self.count("misses")
+            return None
+
+        with self.lock:
+            self.db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        self.count("hits")
+        self.count("bytes_read", size)
+        return df
+
+    def put(self, method, d, df, ttl=None, fetched_at=None):
+        key = self.key(method, d)
+        path, fmt = self.write(key, df)
+        size = getsize(path)
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (key, method.__qualname__, json.dumps(d), path, fmt, size,
+                             now if fetched_at is None else fetched_at, now, ttl))
+            self.db.commit()
+            self.bytes += size - (0 if old is None else old[0])
+        self.count("bytes_written", size)
+        self.evict()
+        return path
+
+    def write(self, key, df):
+        if isinstance(df, pd.DataFrame):
+            path = join(self.directory, key + ".parquet")
+            try:
+                df.to_parquet(path + ".tmp", compression="zstd")
+                os.replace(path + ".tmp", path)
+                return path, "parquet"
+            except (ArrowException, ValueError, TypeError):
+                log.info("{} isn't columnar friendly, storing as a pickle".format(key))
+                if exists(path + ".tmp"):
+                    os.remove(path + ".tmp")
+
+        path = join(self.directory, key + ".pkl.xz")
+        with lzma.open(path + ".tmp", "wb") as f:
+            pickle.dump(df, f)
+        os.replace(path + ".tmp", path)
+        return path, "pickle"
+
+    @staticmethod
+    def read(path, fmt):
+        if fmt == "parquet":
+            return pd.read_parquet(path)
+        with lzma.open(path, "rb") as f:
+            return pickle.load(f)
+
+    def migrate(self, method, d):
+        # Pull a response out of the old loose "{key}.pkl" layout into the index. It expires like a fresh response
+        # would, counted from when the file was written.
+        key = self.key(method, d)
+        legacy = join(self.directory, key + ".pkl")
+        if not exists(legacy):
+            return None
+
+        ttl, fetched_at = ttl_for(d), os.path.getmtime(legacy)
+        if ttl is not None and time.time() > fetched_at + ttl:
+            log.info("Legacy cache entry expired: {}".format(legacy))
+            os.remove(legacy)
+            return None
+        with open(legacy, "rb") as f:
+            df = pickle.load(f)
+        self.count("hits")
+        self.count("bytes_read", getsize(legacy))
+        self.put(method, d, df, ttl=ttl, fetched_at=fetched_at)
+        os.remove(legacy)
+        log.info("Migrated {} into the cache index".format(legacy))
+        return df
+
+    def remove(self, key, path):
+        with self.lock:
+            row = self.db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.db.commit()
+            self.bytes -= 0 if row is None else row[0]
+        if exists(path):
+            os.remove(path)
+
+    def evict(self):
+        while self.total_bytes() > self.max_bytes:
+            with self.lock:
+                rows = self.db.execute("SELECT key, path FROM entries ORDER BY accessed_at LIMIT 100").fetchall()
+            if len(rows) == 0:
+                break
+            for key, path in rows:
+                self.remove(key, path)
+                self.count("evictions")
+                if self.total_bytes() <= self.max_bytes:
+                    break
+            log.info("Evicted cache entries, {} bytes left".format(self.total_bytes()))
+
+    def report(self):
+        return "{hits} hits, {misses} misses, {bytes_read} bytes read, {bytes_written} bytes written, " \
+               "{evictions} evictions".format(**self.stats)
@@ -1,8 +1,163 @@
-import pull_data, clean_data, create_docs, create_tar
+import argparse
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os.path import join, exists
+from threading import Lock
 
-if __name__ == "__main__":
-    pull_data.main()
-    clean_data.main()
-    create_docs.main()
+import pull_data, clean_data, create_docs, create_tar, storage
+from boilerplate import cleanup_methods, data_types
+from logging_config import log
+from storage import exists_table, list_tables, table_files
+
+# Build tables are pulled, then cleaned, then documented and archived. Each build table is keyed by a fingerprint of
+# its raw files and of the code and config that clean it, and only tables whose fingerprint moved are rebuilt.
+FINGERPRINTS = join("data", "fingerprints.json")
+lock = Lock()
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_fingerprints():
+    if not exists(FINGERPRINTS):
+        return {}
+    with open(FINGERPRINTS, "r") as f:
+        return json.load(f)
+
+
+def save_fingerprint(stage, name, fingerprint):
+    # Tables finish on different threads, each one is recorded as soon as it is built
+    with lock:
+        fingerprints = load_fingerprints()
+        fingerprints.setdefault(stage, {})[name] = fingerprint
+        with open(FINGERPRINTS + ".tmp", "w") as f:
+            json.dump(fingerprints, f, indent=2, sort_keys=True)
+        os.replace(FINGERPRINTS + ".tmp", FINGERPRINTS)
+
+
+def file_stats(paths):
+    out = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        out.append((path, stat.st_size, stat.st_mtime_ns))
+    return out
+
+
+def input_hash(stage, method):
+    # Partition files are written once under a unique name, so their names, sizes and mtimes identify the content
+    return digest(*file_stats(table_files(stage, method)))
+
+
+def function_source(function):
+    # Closures such as copy_year share one body, the captured values tell them apart
+    cells = [c.cell_contents for c in function.__closure__ or []]
+    return inspect.getsource(function) + repr(cells)
+
+
+def code_hash(method):
+    cleanup = cleanup_methods.get(method)
+    return digest(function_source(cleanup) if cleanup is not None else None,
+                  json.dumps(data_types.get(method), sort_keys=True),
+                  method in clean_data.compact_methods,
+                  inspect.getsource(clean_data), inspect.getsource(storage))
+
+
+def clean_fingerprint(method):
+    return {"input": input_hash("raw", method), "code": code_hash(method)}
+
+
+def plan_clean(incremental=False):
+    # Returns [(method, action, reason)], action is one of "skip", "clean" or "refresh"
+    stored = load_fingerprints().get("clean", {})
+    steps = []
+    for method in list_tables("raw"):
+        fingerprint = clean_fingerprint(method)
+        old = stored.get(method)
+        if not exists_table("build", method):
+            steps.append((method, "clean", "no build table"))
+        elif old is None:
+            steps.append((method, "clean", "no fingerprint"))
+        elif old["code"] != fingerprint["code"]:
+            steps.append((method, "clean", "cleanup code or data types changed"))
+        elif old["input"] != fingerprint["input"]:
+            if incremental and clean_data.stale_since(method) is not None:
+                steps.append((method, "refresh", "new games since {}".format(clean_data.stale_since(method))))
+            else:
+                steps.append((method, "clean", "raw data changed"))
+        else:
+            steps.append((method, "skip", "up to date"))
+    return steps
+
+
+def docs_fingerprint():
+    clean = load_fingerprints().get("clean", {})
+    return digest(json.dumps(clean, sort_keys=True), inspect.getsource(create_docs),
+                  *file_stats([join("data", "descriptions.csv")]))
+
+
+def run_clean(steps, workers=None):
+    # Tables are independent of each other, so they are cleaned side by side with their partitions sharing one
+    # process pool
+    pending = [step for step in steps if step[1] != "skip"]
+    if len(pending) == 0:
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+
+    def build(step):
+        method, action, _ = step
+        clean_data.build(method, pool, clean_data.stale_since(method) if action == "refresh" else None)
+        # The fingerprint is taken after the build, a refresh may have run against newer raw files than planned
+        save_fingerprint("clean", method, clean_fingerprint(method))
+        return method
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(pending), workers or os.cpu_count()))) as threads:
+        for method in threads.map(build, pending):
+            log.info("Built {}".format(method))
+    if pool is not None:
+        pool.shutdown()
+
+
+def main(incremental=False, workers=None, pull=True, dry_run=False):
+    if dry_run:
+        if pull:
+            for method, (_, since) in pull_data.plan(incremental).items():
+                print("pull    {:45} {}".format(method.__qualname__, "full" if since is None else "since {}".format(since)))
+        steps = plan_clean(incremental)
+        for method, action, reason in steps:
+            print("{:7} {:45} {}".format(action, method, reason))
+        # Every table cleaned changes the docs fingerprint, which is only taken after the rebuild
+        docs = any(action != "skip" for _, action, _ in steps) or not exists(join("data", "csv", "api.csv")) \
+            or load_fingerprints().get("docs", {}).get("api") != docs_fingerprint()
+        print("docs    {}".format("stale" if docs else "up to date"))
+        return
+
+    if pull:
+        pull_data.main(incremental=incremental)
+    run_clean(plan_clean(incremental), workers)
+
+    # The docs fingerprint covers every build fingerprint, so any rebuilt table makes the docs stale
+    fingerprint = docs_fingerprint()
+    if load_fingerprints().get("docs", {}).get("api") != fingerprint or not exists(join("data", "csv", "api.csv")):
+        create_docs.main(workers=workers)
+        save_fingerprint("docs", "api", fingerprint)
     create_tar.main()
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="Refresh tables with new games instead of pulling and cleaning them from scratch")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-pull", action="store_true", help="Rebuild from the raw data already on disk")
+    parser.add_argument("--dry-run", action="store_true", help="Print what would be rebuilt and why, then stop")
+    args = parser.parse_args()
+    main(incremental=args.incremental, workers=args.workers, pull=not args.no_pull, dry_run=args.dry_run)
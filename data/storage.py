@@ -0,0 +1,527 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import uuid
+from glob import glob
+from os.path import join, exists, isdir, basename
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_extension_array_dtype, is_float_dtype, \
+    is_integer_dtype, is_object_dtype, is_string_dtype
+
+from logging_config import log
+
+# Tables live in data/{stage}/{method}/ as part files. Tables with a year column are partitioned into
+# "{column}={year}" directories so readers only open the seasons they ask for.
+NULL_PARTITION = "__null__"
+
+# Raw tables are written once and read rarely, so they're compressed parquet. Build tables are read by every
+# downstream script, so they're uncompressed Arrow IPC files that can be memory-mapped and shared between processes.
+FORMATS = {"raw": "parquet", "build": "arrow"}
+
+
+def table_path(stage, method):
+    return join("data", stage, method)
+
+
+def legacy_path(stage, method):
+    return join("data", stage, method + ".pkl")
+
+
+def exists_table(stage, method):
+    return isdir(table_path(stage, method)) or exists(legacy_path(stage, method))
+
+
+def list_tables(stage):
+    names = {basename(path) for path in glob(join("data", stage, "*")) if isdir(path) and not path.endswith(".tmp")}
+    names.update(basename(path).replace(".pkl", "") for path in glob(join("data", stage, "*.pkl")))
+    return sorted(names)
+
+
+def partition_name(column, value):
+    if pd.isna(value):
+        return "{}={}".format(column, NULL_PARTITION)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return "{}={}".format(column, value)
+
+
+def parse_partition(name):
+    column, value = name.split("=", 1)
+    if value == NULL_PARTITION:
+        return column, None
+    try:
+        return column, int(value)
+    except ValueError:
+        return column, value
+
+
+def partitions(stage, method):
+    # [(column, value, directory)] for partitioned tables, [(None, None, directory)] otherwise
+    path = table_path(stage, method)
+    dirs = sorted(d for d in glob(join(path, "*=*")) if isdir(d))
+    if len(dirs) == 0:
+        return [(None, None, path)]
+    return [parse_partition(basename(d)) + (d,) for d in dirs]
+
+
+def part_files(directory):
+    return sorted(f for f in glob(join(directory, "part-*")) if not f.endswith(".tmp"))
+
+
+def arrow_safe(df):
+    # pybaseball hands back object columns that mix strings and numbers, parquet needs one type per column
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            df[column] = df[column].map(lambda v: v if pd.isna(v) else str(v))
+    return df
+
+
+def to_arrow(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Plain float columns keep NaN as a value rather than a null, so a memory-mapped column is usable as is
+    for i, name in enumerate(table.column_names):
+        if df[name].dtype.kind == "f":
+            table = table.set_column(i, table.field(i), pa.array(df[name].to_numpy(), from_pandas=False))
+    return table
+
+
+def write_file(path, df, fmt, metadata=None):
+    # metadata is extra key/value pairs for the file's schema
+    if fmt == "arrow":
+        table = to_arrow(df)
+        if metadata is not None:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+        with pa.OSFile(path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif metadata is not None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata}), path,
+                       compression="zstd")
+    else:
+        df.to_parquet(path, compression="zstd", index=False)
+
+
+def write_part(directory, df, fmt="parquet"):
+    os.makedirs(directory, exist_ok=True)
+    # The random suffix keeps worker processes appending to the same partition from clobbering each other
+    n = len(part_files(directory))
+    path = join(directory, "part-{:05d}-{}.{}".format(n, uuid.uuid4().hex[:8], fmt))
+    df = df.reset_index(drop=True)
+    try:
+        write_file(path + ".tmp", df, fmt)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        write_file(path + ".tmp", arrow_safe(df), fmt)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def read_part(path, columns=None, mmap=False):
+    if path.endswith(".arrow"):
+        # A memory-mapped table's buffers keep the mapping alive after the file is closed
+        with (pa.memory_map(path, "r") if mmap else pa.OSFile(path, "rb")) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return table if columns is None else table.select(columns)
+    return pq.read_table(path, columns=columns)
+
+
+def append_table(stage, method, df, partition_by=None):
+    # Adds part files next to whatever is already in the table
+    fmt = FORMATS.get(stage, "parquet")
+    if partition_by is None or partition_by not in df.columns:
+        write_part(table_path(stage, method), df, fmt)
+        return
+    for value, part in df.groupby(df[partition_by], dropna=False, sort=True):
+        write_part(join(table_path(stage, method), partition_name(partition_by, value)), part, fmt)
+
+
+def begin_table(stage, method):
+    # Tables being rebuilt are written under "{method}.tmp" and swapped in by commit_table, so readers never see
+    # half a table. Returns the name to append to.
+    tmp = method + ".tmp"
+    if exists(table_path(stage, tmp)):
+        shutil.rmtree(table_path(stage, tmp))
+    return tmp
+
+
+def commit_table(stage, method):
+    path = table_path(stage, method)
+    tmp = table_path(stage, method + ".tmp")
+    if not exists(tmp):
+        os.makedirs(tmp)
+    if isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+    if exists(legacy_path(stage, method)):
+        os.remove(legacy_path(stage, method))
+
+
+def write_table(stage, method, df, partition_by=None):
+    # Replaces the whole table
+    append_table(stage, begin_table(stage, method), df, partition_by)
+    commit_table(stage, method)
+    log.info("Wrote {} rows to {}".format(len(df), table_path(stage, method)))
+
+
+class TableWriter:
+    # Streams frames into a table as they arrive, so only one of them is in memory at a time. Each frame is
+    # reconciled against the dtypes seen so far and cast where it can be, anything that can't is widened by concat()
+    # when the table is read. The table only replaces the old one once close() is called.
+
+    def __init__(self, stage, method, partition_by=None):
+        self.stage = stage
+        self.method = method
+        self.partition_by = partition_by
+        self.target = begin_table(stage, method)
+        self.dtypes = {}
+        self.rows = 0
+
+    def reconcile(self, df):
+        for column in df.columns:
+            dtype = self.dtypes.get(column)
+            if dtype is None:
+                self.dtypes[column] = df[column].dtype
+            elif df[column].dtype != dtype:
+                # Only cast when nothing is lost, e.g. 1.5 must not quietly become 1
+                try:
+                    cast = df[column].astype(dtype)
+                    lossless = cast.astype(df[column].dtype).equals(df[column])
+                except (ValueError, TypeError):
+                    lossless = False
+                if lossless:
+                    df[column] = cast
+                else:
+                    log.info("Column {} of {} doesn't fit {}, keeping {}".format(column, self.method, dtype,
+                                                                                 df[column].dtype))
+        return df
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+        append_table(self.stage, self.target, self.reconcile(df.copy()), self.partition_by)
+        self.rows += len(df)
+
+    def close(self):
+        # Returns False, and leaves the old table alone, if nothing was written
+        if self.rows == 0:
+            self.abort()
+            return False
+        commit_table(self.stage, self.method)
+        log.info("Wrote {} rows to {}".format(self.rows, table_path(self.stage, self.method)))
+        return True
+
+    def abort(self):
+        if exists(table_path(self.stage, self.target)):
+            shutil.rmtree(table_path(self.stage, self.target))
+
+
+def write_partition(stage, method, df, partition_by, value):
+    # Replaces a single partition, the rest of the table is left alone
+    directory = join(table_path(stage, method), partition_name(partition_by, value))
+    tmp = directory + ".tmp"
+    if exists(tmp):
+        shutil.rmtree(tmp)
+    write_part(tmp, df, FORMATS.get(stage, "parquet"))
+    if isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp, directory)
+
+
+def part_schema(path):
+    if path.endswith(".arrow"):
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).schema
+    return pq.read_schema(path)
+
+
+def schema_columns(stage, method):
+    for _, _, directory in partitions(stage, method):
+        for file in part_files(directory):
+            return part_schema(file).names
+    return []
+
+
+def table_files(stage, method):
+    files = [f for _, _, directory in partitions(stage, method) for f in part_files(directory)]
+    if len(files) == 0 and exists(legacy_path(stage, method)):
+        files = [legacy_path(stage, method)]
+    return files
+
+
+def table_bytes(stage, method):
+    return sum(os.path.getsize(f) for f in table_files(stage, method))
+
+
+def read_legacy(stage, method, columns=None, years=None):
+    with open(legacy_path(stage, method), "rb") as f:
+        df = pickle.load(f)
+    if years is not None and "year" in df.columns:
+        df = df[df["year"].isin(list(years))]
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+
+# Text columns with at most this many distinct values are stored as categoricals
+CATEGORY_LIMIT = 1024
+
+INT_TYPES = ["int8", "int16", "int32", "int64"]
+# Schema metadata key of compacted part files
+COMPACT_KEY = b"compact_schema"
+
+
+def float32_exact(series):
+    # True if every value survives a round trip through float32
+    values = series.to_numpy(dtype="float64", na_value=np.nan)
+    with np.errstate(over="ignore", invalid="ignore"):
+        narrowed = values.astype("float32").astype("float64")
+    return bool(np.array_equal(narrowed, values, equal_nan=True))
+
+
+def column_stats(df):
+    # A per column summary a compact schema can be chosen from. Small enough to send back from a worker process.
+    stats = {}
+    for column in df.columns:
+        series = df[column]
+        if is_bool_dtype(series) or is_datetime64_any_dtype(series):
+            continue
+        if is_integer_dtype(series):
+            present = series.dropna()
+            stats[column] = {
+                "kind": "int",
+                "nullable": is_extension_array_dtype(series),
+                "min": int(present.min()) if len(present) > 0 else None,
+                "max": int(present.max()) if len(present) > 0 else None
+            }
+        elif is_float_dtype(series):
+            stats[column] = {"kind": "float", "float32": float32_exact(series)}
+        elif is_object_dtype(series) or is_string_dtype(series):
+            values = pd.unique(series.dropna())
+            if not all(isinstance(v, str) for v in values[:CATEGORY_LIMIT + 1]):
+                continue
+            stats[column] = {"kind": "text", "values": None if len(values) > CATEGORY_LIMIT else sorted(values),
+                             "string": isinstance(series.dtype, pd.StringDtype)}
+    return stats
+
+
+def merge_stats(a, b):
+    out = {}
+    for column in set(a) | set(b):
+        x, y = a.get(column), b.get(column)
+        if x is None or y is None:
+            out[column] = x if y is None else y
+        elif x["kind"] != y["kind"]:
+            continue
+        elif x["kind"] == "int":
+            lows = [v for v in (x["min"], y["min"]) if v is not None]
+            highs = [v for v in (x["max"], y["max"]) if v is not None]
+            out[column] = {"kind": "int", "nullable": x["nullable"] or y["nullable"],
+                           "min": min(lows) if len(lows) > 0 else None, "max": max(highs) if len(highs) > 0 else None}
+        elif x["kind"] == "text":
+            if x["values"] is None or y["values"] is None:
+                values = None
+            else:
+                values = sorted(set(x["values"]) | set(y["values"]))
+                values = None if len(values) > CATEGORY_LIMIT else values
+            out[column] = {"kind": "text", "values": values, "string": x.get("string", True) and y.get("string", True)}
+        else:
+            out[column] = {"kind": "float", "float32": x.get("float32", False) and y.get("float32", False)}
+    return out
+
+
+def choose_schema(stats):
+    # Smallest int that holds the range, float32 only for floats it holds exactly and categoricals for low
+    # cardinality text
+    schema = {}
+    for column, s in stats.items():
+        if s["kind"] == "int" and s["min"] is not None:
+            for dtype in INT_TYPES:
+                info = np.iinfo(dtype)
+                if info.min <= s["min"] and s["max"] <= info.max:
+                    schema[column] = {"dtype": dtype.capitalize() if s["nullable"] else dtype}
+                    break
+        elif s["kind"] == "float" and s.get("float32", False):
+            schema[column] = {"dtype": "float32"}
+        elif s["kind"] == "text" and s["values"] is not None:
+            schema[column] = {"dtype": "category", "categories": s["values"]}
+    return schema
+
+
+def schema_path(stage, method):
+    return join(table_path(stage, method), "_schema.json")
+
+
+def load_schema(stage, method):
+    # Returns (schema, stats), both empty when the table isn't compact
+    path = schema_path(stage, method)
+    if not exists(path):
+        return {}, {}
+    with open(path, "r") as f:
+        saved = json.load(f)
+    return saved["columns"], saved["stats"]
+
+
+def save_schema(stage, method, stats):
+    # Returns the chosen schema
+    path = schema_path(stage, method)
+    schema = choose_schema(stats)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"columns": schema, "stats": stats}, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+    return schema
+
+
+def compact_frame(df, schema):
+    # Casts a frame to the compact types. The categories are the table's recorded ones, so every partition has the
+    # same categoricals. A value missing from them keeps its column as it is rather than becoming NaN.
+    for column, spec in schema.items():
+        if column not in df.columns:
+            continue
+        if spec["dtype"] == "category":
+            values = pd.Categorical(df[column], categories=spec["categories"])
+            if (pd.isna(values) & df[column].notna().to_numpy()).any():
+                log.info("Column {} has values outside its categories, keeping it as text".format(column))
+                continue
+            df[column] = values
+        else:
+            df[column] = df[column].astype(spec["dtype"])
+    return df
+
+
+def expand_frame(df, stats):
+    # The reverse of compact_frame: the types the cleaned frames had before they were compacted
+    for column, s in stats.items():
+        if column not in df.columns:
+            continue
+        if s["kind"] == "int":
+            dtype = "Int64" if s["nullable"] else "int64"
+        elif s["kind"] == "float":
+            dtype = "float64"
+        else:
+            # Schemas saved before text columns recorded their type default to "string", what data_types cleans text to
+            dtype = "string" if s.get("string", True) else object
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def compact_table(stage, method, schema):
+    # Writes the compact types into the part files, so readers get them straight from the files without a conversion.
+    # Each file records the schema it was compacted to and only files compacted to another one are rewritten.
+    stamp = hashlib.md5(json.dumps(schema, sort_keys=True).encode()).hexdigest().encode()
+    rewritten = 0
+    for _, _, directory in partitions(stage, method):
+        for path in part_files(directory):
+            if (part_schema(path).metadata or {}).get(COMPACT_KEY) == stamp:
+                continue
+            df = compact_frame(read_part(path).to_pandas(), schema)
+            write_file(path + ".tmp", df, "arrow" if path.endswith(".arrow") else "parquet", {COMPACT_KEY: stamp})
+            os.replace(path + ".tmp", path)
+            rewritten += 1
+    log.info("Compacted {} part files of {}".format(rewritten, method))
+
+
+def widen(a, b):
+    # The narrowest type both a and b can be cast to
+    if a.equals(b) or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    if pa.types.is_integer(a) and pa.types.is_integer(b):
+        return pa.int64()
+    if (pa.types.is_integer(a) or pa.types.is_floating(a)) and (pa.types.is_integer(b) or pa.types.is_floating(b)):
+        return pa.float64()
+    return pa.string()
+
+
+def conform(table, schema):
+    columns = []
+    for field in schema:
+        if field.name not in table.column_names:
+            columns.append(pa.nulls(table.num_rows, field.type))
+        elif table.schema.field(field.name).type.equals(field.type):
+            columns.append(table.column(field.name))
+        else:
+            columns.append(table.column(field.name).cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def concat(tables):
+    # Part files written from different responses can disagree on columns and types, widen them to one schema
+    if len(tables) == 1:
+        return tables[0]
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types[field.name] = widen(types[field.name], field.type) if field.name in types else field.type
+    schema = pa.schema([pa.field(name, t) for name, t in types.items()])
+    if all(table.schema.equals(schema) for table in tables):
+        return pa.concat_tables(tables)
+
+    # The pandas metadata of the first part only still describes the columns if none of its types were widened
+    first = tables[0].schema
+    if all(types[field.name].equals(field.type) for field in first):
+        schema = schema.with_metadata(first.metadata)
+    return pa.concat_tables([conform(table, schema) for table in tables])
+
+
+def iter_tables(stage, method, columns=None, years=None, mmap=False):
+    # Yields (year, pyarrow.Table) one partition at a time
+    if columns is not None:
+        available = set(schema_columns(stage, method))
+        columns = [c for c in columns if c in available]
+
+    years = None if years is None else set(years)
+    for column, value, directory in partitions(stage, method):
+        if years is not None and column is not None and value not in years:
+            continue
+        files = part_files(directory)
+        if len(files) == 0:
+            continue
+        yield value, concat([read_part(f, columns, mmap) for f in files])
+
+
+def to_pandas(table, mmap=False):
+    # split_blocks keeps every column in its own block, so single chunk numeric columns stay views of the map
+    if mmap:
+        return table.to_pandas(split_blocks=True)
+    return table.to_pandas()
+
+
+def iter_partitions(stage, method, columns=None, years=None, mmap=False, compact=True):
+    # Yields (year, DataFrame) one partition at a time. Unpartitioned tables come back as a single (None, df).
+    # With mmap the numeric columns of Arrow files are read-only, zero-copy views of the page cache, so processes
+    # reading the same table share memory. Copy a frame before writing into it. Tables built in compact mode store
+    # their compact types, with compact False they come back in the types they were cleaned to.
+    if not isdir(table_path(stage, method)):
+        yield None, read_legacy(stage, method, columns, years)
+        return
+
+    stats = {} if compact else load_schema(stage, method)[1]
+    for value, table in iter_tables(stage, method, columns, years, mmap):
+        df = to_pandas(table, mmap)
+        if len(stats) > 0:
+            df = expand_frame(df, stats)
+        # Unpartitioned tables are filtered on their year column, the __null__ partition is read whole
+        if years is not None and value is None and None not in years and "year" in df.columns:
+            df = df[df["year"].isin(list(years))]
+        yield value, df
+
+
+def read_table(stage, method, columns=None, years=None, mmap=False, compact=True):
+    # Only the requested columns and year partitions are read from disk. A single partition read with mmap is
+    # zero-copy, reading several concatenates them into one frame.
+    frames = [df for _, df in iter_partitions(stage, method, columns, years, mmap, compact)]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
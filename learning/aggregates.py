@@ -0,0 +1,197 @@
+import datetime
+import json
+import os
+from os.path import join, exists
+
+import numpy as np
+import pandas as pd
+
+from logging_config import log
+
+# The pitch columns summarized per (pitcher, year, pitch type), and the zones pitches are bucketed into
+PITCH_STATS = ["release_spin_rate", "effective_speed", "spin_axis", "release_speed", "pfx_x", "pfx_z", "plate_x",
+               "plate_z"]
+MERGED_ZONES = ["strike_high", "strike_middle", "strike_low", "ball_high", "ball_low"]
+ZONE_NAMES = {1: "strike_high", 2: "strike_high", 3: "strike_high",
+              4: "strike_middle", 5: "strike_middle", 6: "strike_middle",
+              7: "strike_low", 8: "strike_low", 9: "strike_low",
+              11: "ball_high", 12: "ball_high",
+              13: "ball_low", 14: "ball_low"}
+# Zone number -> position in MERGED_ZONES, -1 for the zones that aren't merged
+ZONE_CODES = np.full(max(ZONE_NAMES) + 1, -1, dtype=np.int8)
+for zone, name in ZONE_NAMES.items():
+    ZONE_CODES[zone] = MERGED_ZONES.index(name)
+
+KEYS = ["pitcher", "year", "pitch_type"]
+STATE_DIRECTORY = join("learning", "tmp")
+
+
+def feature_columns(pitches):
+    columns = ["player_id", "year"]
+    for pitch in pitches:
+        for column in PITCH_STATS:
+            columns.append(pitch + "_" + column + "_mean")
+            columns.append(pitch + "_" + column + "_std")
+        for zone in MERGED_ZONES:
+            columns.append(pitch + "_" + zone)
+    return columns
+
+
+def merged_zones(zone):
+    # One lookup over the zone numbers instead of a map through the zone names. Missing and unmerged zones come out
+    # missing.
+    z = zone.to_numpy(dtype="float64", na_value=np.nan)
+    known = np.isfinite(z) & (z >= 0) & (z < len(ZONE_CODES)) & (z == np.floor(z))
+    codes = np.full(len(z), -1, dtype=np.int8)
+    codes[known] = ZONE_CODES[z[known].astype(np.int64)]
+    return pd.Categorical.from_codes(codes, categories=MERGED_ZONES)
+
+
+def partial(pitcher, positions=None):
+    # The aggregate state of one chunk of normalized pitches: per (pitcher, year, pitch) cell the pitch count, the
+    # mean and M2 (sum of squared deviations) of every stat and the count of pitches in each merged zone. The ranks
+    # are the row a pitcher and a (pitcher, year) first show up on, so rows can be emitted in that order. Rows are
+    # counted over the chunk, or given as positions when the chunk is picked out of a larger one.
+    rows = len(pitcher)
+    pitcher = pitcher.assign(position=np.arange(rows) if positions is None else positions)
+    pitcher = pitcher.dropna(subset=PITCH_STATS)
+    # Compact build tables store these as float32, the stats are still worked out in float64
+    pitcher = pitcher.astype({column: "float64" for column in PITCH_STATS})
+    pitcher = pitcher.dropna(subset=["zone"])
+    # normalize() has usually bucketed the zones already
+    zones = pitcher["merged_zone"] if "merged_zone" in pitcher.columns else merged_zones(pitcher.zone)
+    pitcher = pitcher.assign(pitch_type=pitcher.pitch_type.astype(str), merged_zone=zones).reset_index(drop=True)
+
+    grouped = pitcher.groupby(KEYS, sort=False)
+    counts = grouped.size()
+    frame = pd.concat([counts.rename("n"),
+                       grouped[PITCH_STATS].mean().add_suffix("_mean"),
+                       (grouped[PITCH_STATS].var(ddof=0).mul(counts, axis=0)).add_suffix("_m2"),
+                       pitcher.groupby(KEYS + ["merged_zone"], sort=False, observed=True).size()
+                       .unstack("merged_zone", fill_value=0).reindex(columns=MERGED_ZONES, fill_value=0)], axis=1)
+    frame[MERGED_ZONES] = frame[MERGED_ZONES].fillna(0).astype("int64")
+
+    first_pitcher = pitcher.position.groupby(pitcher.pitcher, sort=False).min()
+    first_pair = pitcher.position.groupby([pitcher.pitcher, pitcher.year], sort=False).min()
+    frame["pitcher_rank"] = first_pitcher.reindex(frame.index.get_level_values("pitcher")).to_numpy()
+    frame["pair_rank"] = first_pair.reindex(frame.index.droplevel("pitch_type")).to_numpy()
+    return frame, rows
+
+
+def combine(frames):
+    # Merges any number of states in one grouped pass. Means are weighted by count and the M2s add up along with
+    # each part's count times its squared distance from the combined mean.
+    both = pd.concat(frames)
+    if len(frames) == 1:
+        return both
+    grouped = both.groupby(level=KEYS, sort=False)
+    n = grouped["n"].sum()
+    weight = both["n"].to_numpy()[:, None]
+    means = both[[c + "_mean" for c in PITCH_STATS]].to_numpy()
+    mean = pd.DataFrame(means * weight, index=both.index, columns=[c + "_mean" for c in PITCH_STATS]) \
+        .groupby(level=KEYS, sort=False).sum().div(n, axis=0)
+    spread = (means - mean.reindex(both.index).to_numpy()) ** 2 * weight
+    m2 = pd.DataFrame(both[[c + "_m2" for c in PITCH_STATS]].to_numpy() + spread, index=both.index,
+                      columns=[c + "_m2" for c in PITCH_STATS]).groupby(level=KEYS, sort=False).sum()
+    return pd.concat([n, mean, m2, grouped[MERGED_ZONES].sum(), grouped[["pitcher_rank", "pair_rank"]].min()],
+                     axis=1)
+
+
+class PitchState:
+    # Running aggregates behind the pitcher features. States fold in new pitches and merge with each other without
+    # going back to the pitches already folded, and the wide feature frame can be emitted from them at any point.
+
+    def __init__(self, frame=None, pitches=None, rows=0, watermark=None):
+        self.frame = frame
+        self.pitches = [] if pitches is None else list(pitches)
+        self.rows = rows
+        self.watermark = watermark
+
+    def add_pitches(self, pitches):
+        for pitch in pitches:
+            if pitch not in self.pitches:
+                self.pitches.append(pitch)
+
+    def fold(self, pitcher, positions=None):
+        # pitcher is normalized pitches, see create_data.normalize(). They're taken to be the next rows after the
+        # state's, unless their positions among the state's rows are given, in which case the caller keeps count.
+        if len(pitcher) == 0:
+            return self
+        self.add_pitches(str(p) for p in pd.unique(pitcher.pitch_type))
+        frame, rows = partial(pitcher, positions)
+        if "game_date" in pitcher.columns and len(pitcher) > 0:
+            day = pd.to_datetime(pitcher.game_date).max().date()
+            self.watermark = day if self.watermark is None else max(self.watermark, day)
+        if positions is None:
+            self.merge(PitchState(frame, rows=rows))
+        else:
+            self.merge(PitchState(frame), shift=0)
+        return self
+
+    def merge(self, other, shift=None):
+        # other's pitches are taken to come after this state's, so its ranks are shifted past them unless a shift
+        # is given
+        shift = self.rows if shift is None else shift
+        if other.frame is not None and len(other.frame) > 0:
+            shifted = other.frame.copy()
+            shifted[["pitcher_rank", "pair_rank"]] += shift
+            self.frame = shifted if self.frame is None else combine([self.frame, shifted])
+        self.rows += other.rows
+        self.add_pitches(other.pitches)
+        if other.watermark is not None:
+            self.watermark = other.watermark if self.watermark is None else max(self.watermark, other.watermark)
+        return self
+
+    def emit(self, pitches=None):
+        # The wide "{pitch}_{column}_{mean|std}" and "{pitch}_{zone}" frame, one row per (pitcher, year)
+        pitches = self.pitches if pitches is None else pitches
+        if self.frame is None or len(self.frame) == 0:
+            return pd.DataFrame(columns=feature_columns(pitches))
+        frame = self.frame
+        n = frame["n"]
+        cells = pd.concat([frame[[c + "_mean" for c in PITCH_STATS]],
+                           np.sqrt(frame[[c + "_m2" for c in PITCH_STATS]].div(n, axis=0))
+                           .rename(columns=lambda c: c[:-len("_m2")] + "_std"),
+                           frame[MERGED_ZONES].div(n, axis=0)], axis=1)
+
+        # Pivot the pitch types out into "{pitch}_{column}" columns
+        wide = cells.unstack("pitch_type")
+        wide.columns = ["{}_{}".format(pitch, column) for column, pitch in wide.columns]
+
+        # Rows come out per pitcher in the order pitchers first appear, then per year in the order it first appears
+        ranks = frame[["pitcher_rank", "pair_rank"]].groupby(level=["pitcher", "year"], sort=False).min()
+        # A pitcher's rank is the earliest over all their cells, chunks of other seasons saw them at other rows
+        ranks["pitcher_rank"] = ranks.groupby(level="pitcher", sort=False)["pitcher_rank"].transform("min")
+        wide = wide.reindex(ranks.sort_values(["pitcher_rank", "pair_rank"], kind="stable").index)
+
+        out = wide.reset_index().rename(columns={"pitcher": "player_id"})
+        out = out.reindex(columns=feature_columns(pitches))
+        # Pitch types nobody threw come out as empty columns, they're float like the rest. Ids and years are int64
+        # like agg_pitchers emitted them, whatever compact types the pitches were read in.
+        dtypes = {column: "float64" for column in out.columns[2:]}
+        dtypes.update(player_id="int64", year="int64")
+        return out.astype(dtypes)
+
+    def save(self, name="pitch_state"):
+        if self.frame is None:
+            return
+        os.makedirs(STATE_DIRECTORY, exist_ok=True)
+        path = join(STATE_DIRECTORY, name)
+        self.frame.reset_index().to_parquet(path + ".parquet.tmp", compression="zstd", index=False)
+        with open(path + ".json.tmp", "w") as f:
+            json.dump({"pitches": self.pitches, "rows": self.rows,
+                       "watermark": None if self.watermark is None else self.watermark.isoformat()}, f, indent=2)
+        os.replace(path + ".parquet.tmp", path + ".parquet")
+        os.replace(path + ".json.tmp", path + ".json")
+        log.info("Saved pitch state through {} ({} cells)".format(self.watermark, len(self.frame)))
+
+    @staticmethod
+    def load(name="pitch_state"):
+        path = join(STATE_DIRECTORY, name)
+        if not exists(path + ".parquet") or not exists(path + ".json"):
+            return None
+        with open(path + ".json", "r") as f:
+            meta = json.load(f)
+        frame = pd.read_parquet(path + ".parquet").set_index(KEYS)
+        watermark = None if meta["watermark"] is None else datetime.date.fromisoformat(meta["watermark"])
+        return PitchState(frame, meta["pitches"], meta["rows"], watermark)
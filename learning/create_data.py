@@ -1,58 +1,119 @@
-from os.path import join, exists
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, getsize
 import pickle
 from logging_config import log
+from metrics import stage
 import pandas as pd
 import numpy as np
-from pybaseball import playerid_lookup, chadwick_register
+from crosswalk import get_crosswalk
+from data.storage import read_table, iter_partitions
+from learning.aggregates import PitchState, merged_zones
+from learning.names import name_index
 
+# First season of features, independent of the seasons boilerplate pulls from
 START_YEAR = 2016
 #https://statsapi.mlb.com/api/v1/pitchTypes
+DROPPED_PITCHES = ["IN", "EP", "PO", "SC", "FA", "CS", "KN"]
+MERGED_PITCHES = {"FO": "FS", "SI": "SIFT", "FT": "SIFT", "CU": "CUKC", "KC": "CUKC"}
+
+
+# The only statcast columns the pitch aggregation touches
+PITCH_COLUMNS = ["pitcher", "year", "game_date", "pitch_type", "p_throws", "zone", "release_spin_rate",
+                 "effective_speed", "spin_axis", "release_speed", "pfx_x", "pfx_z", "plate_x", "plate_z"]
 
 
 def load_dataframes():
+    # The pitches aren't loaded here, each season is read and folded on its own by fold_season()
     log.info("Loading dataframes")
-    # with open(join("data", "build", "statcast_pitcher_percentile_ranks.pkl"), "rb") as f:
-    #     percentile_ranks = pickle.load(f)
-    #     percentile_ranks = percentile_ranks[percentile_ranks.year >= START_YEAR]
-    # with open(join("data", "build", "statcast_pitcher_active_spin.pkl"), "rb") as f:
-    #     active_spin = pickle.load(f)
-    #     active_spin = active_spin[active_spin.year >= START_YEAR]
-    # with open(join("data", "build", "statcast_pitcher_pitch_movement.pkl"), "rb") as f:
-    #     movement = pickle.load(f)
-    #     movement = movement[movement.year >= START_YEAR]
-    with open(join("data", "build", "FangraphsDataTable.fetch.pkl"), "rb") as f:
-        fangraph = pickle.load(f)
-        fangraph = fangraph[fangraph.year >= START_YEAR]
-        # fangraph = fangraph[["xFIP", "FIP", "IDfg", "year"]]
-    with open(join("data", "build", "statcast_pitcher.pkl"), "rb") as f:
-        pitcher = pickle.load(f)
-        pitcher = pitcher[pitcher.year >= START_YEAR]
-        pitcher = pitcher.dropna(subset=["pitch_type"])
+    # percentile_ranks = read_table("build", "statcast_pitcher_percentile_ranks", years=seasons())
+    # active_spin = read_table("build", "statcast_pitcher_active_spin", years=seasons())
+    # movement = read_table("build", "statcast_pitcher_pitch_movement", years=seasons())
+    fangraph = read_table("build", "FangraphsDataTable.fetch", years=seasons())
+    # fangraph = fangraph[["xFIP", "FIP", "IDfg", "year"]]
     log.info("Dataframes loaded")
-    return pitcher, fangraph
+    return fangraph
+
+
+def pitch_years(since=None):
+    return seasons() if since is None else range(max(START_YEAR, since.year), datetime.date.today().year + 1)
+
+
+def iter_pitches(since=None, years=None):
+    # Yields (year, pitches) one year partition at a time, so only a season of pitches is ever in memory and the
+    # whole statcast history can be aggregated. With "since" only the pitches from finished games after that day are
+    # loaded.
+    years = pitch_years(since) if years is None else years
+    # The partitions are memory-mapped, the only copy of a season is the one taking its kept rows
+    for year, pitcher in iter_partitions("build", "statcast_pitcher", columns=PITCH_COLUMNS, years=years, mmap=True):
+        yield year, pitcher[pitcher.pitch_type.notna().to_numpy() & new_games(pitcher, since)]
+
+
+def fold_season(year, since=None):
+    # Reads, normalizes and aggregates one season on its own. Pool workers read their partition straight from the
+    # build table and only send back the season's aggregate state, never its pitches. On full runs today's games are
+    # folded into a state of their own, they're emitted with the rest but kept out of the saved state.
+    state, today = PitchState(), PitchState()
+    rows = 0
+    for _, pitcher in iter_pitches(since, [year]):
+        pitcher = normalize(pitcher)
+        state.add_pitches(str(p) for p in pd.unique(pitcher.pitch_type))
+        playing = todays_games(pitcher) if since is None else np.zeros(len(pitcher), dtype=bool)
+        positions = rows + np.arange(len(pitcher))
+        state.fold(pitcher[~playing], positions[~playing])
+        today.fold(pitcher[playing], positions[playing])
+        rows += len(pitcher)
+    state.rows = rows
+    return state, today, rows
+
+
+def new_games(pitcher, since=None):
+    # Incremental runs only load finished games after "since", the games going on today are left for a later run
+    if since is None:
+        return np.ones(len(pitcher), dtype=bool)
+    days = pd.to_datetime(pitcher.game_date).dt.date
+    return ((days > since) & (days < datetime.date.today())).to_numpy()
+
 
+def todays_games(pitcher):
+    return (pd.to_datetime(pitcher.game_date).dt.date == datetime.date.today()).to_numpy()
 
-def clean_pitches(pitcher):
+
+def seasons():
+    return range(START_YEAR, datetime.date.today().year + 1)
+
+
+def normalize(pitcher):
     # The statcast "pitcher" list has many more pitches than the movement/active_spin list.
     # Here we're either dropping or mapping pitches, so we have the same list as movement/spin.
-    log.info("Consolidating pitches")
-    to_drop = ["IN", "EP", "PO", "SC", "FA", "CS", "KN"]
-    pitcher = pitcher[~pitcher.pitch_type.isin(to_drop)]
-    pitcher.loc[pitcher.pitch_type == "FO", "pitch_type"] = "FS"
-    pitcher.loc[pitcher.pitch_type == "SI", "pitch_type"] = "SIFT"
-    pitcher.loc[pitcher.pitch_type == "FT", "pitch_type"] = "SIFT"
-    pitcher.loc[pitcher.pitch_type == "CU", "pitch_type"] = "CUKC"
-    pitcher.loc[pitcher.pitch_type == "KC", "pitch_type"] = "CUKC"
-    return pitcher
-
-
-def lefty(pitcher):
-    # The spin axis for left-handed pitchers is mirrored across the 12-6 (360-180) axis.
-    log.info("Flipping L to R")
-    pitcher.loc[pitcher.p_throws == "L", "spin_axis"] = (pitcher.loc[pitcher.p_throws == "L", "spin_axis"] - 360).abs()
-    pitcher.loc[pitcher.p_throws == "L", "pfx_x"] = pitcher.loc[pitcher.p_throws == "L", "pfx_x"] * -1
-    pitcher.loc[pitcher.p_throws == "L", "plate_x"] = pitcher.loc[pitcher.p_throws == "L", "plate_x"] * -1
-    return pitcher
+    # The spin axis for left-handed pitchers is mirrored across the 12-6 (360-180) axis, and their horizontal movement
+    # and location are flipped, so every pitcher looks like a right-hander. The zones are bucketed too.
+    # All of it is done in one pass: the pitch types are remapped through a lookup over their codes, one entry per
+    # distinct type, and the left-handed mask is worked out once.
+    log.info("Normalizing pitches")
+    types = pitcher.pitch_type
+    categorical = isinstance(types.dtype, pd.CategoricalDtype)
+    codes, names = (types.cat.codes.to_numpy(), types.cat.categories) if categorical else pd.factorize(types)
+    merged = [MERGED_PITCHES.get(name, name) for name in names]
+    labels = list(dict.fromkeys(m for m in merged if m not in DROPPED_PITCHES))
+    # -2 marks dropped types. A missing pitch type has code -1, which picks the trailing -1 and stays missing.
+    lookup = np.array([-2 if m in DROPPED_PITCHES else labels.index(m) for m in merged] + [-1], dtype=np.int64)
+    new_codes = lookup[codes]
+    keep = new_codes != -2
+    pitcher, new_codes = pitcher[keep], new_codes[keep]
+    if categorical:
+        pitch_type = pd.Categorical.from_codes(new_codes, categories=labels)
+    else:
+        pitch_type = np.array(labels + [np.nan], dtype=object)[new_codes]
+
+    left = (pitcher.p_throws == "L").to_numpy()
+    spin_axis, pfx_x, plate_x = (pitcher[c].to_numpy() for c in ["spin_axis", "pfx_x", "plate_x"])
+    return pitcher.assign(pitch_type=pitch_type,
+                          spin_axis=np.where(left, np.abs(spin_axis - 360), spin_axis),
+                          pfx_x=np.where(left, -pfx_x, pfx_x),
+                          plate_x=np.where(left, -plate_x, plate_x),
+                          merged_zone=merged_zones(pitcher.zone))
 
 
 def rename_spin(active_spin):
@@ -70,118 +131,34 @@ def rename_spin(active_spin):
 
 
 def map_player_ids(movement, active_spin):
-
-    # This method can take a while and results in the exact same thing. So lets cache if we can...
-    cache_movement_path = join("learning", "tmp", "map_player_ids_movement.pkl")
-    cache_spin_path = join("learning", "tmp", "map_player_ids_active_spin.pkl")
-    if exists(cache_movement_path) and exists(cache_spin_path):
-        with open(cache_movement_path, "rb") as cm, open(cache_spin_path, "rb") as cs:
-            return pickle.load(cm), pickle.load(cs)
-
     # Make sure each table has a "player_id" column
     log.info("Finding player_ids for active_spin")
     movement = movement.rename(columns={"pitcher_id": "player_id"})
-    active_spin["player_id"] = -1
-    for idx, row in active_spin.iterrows():
-        if row["player_id"] == -1:
-            lookup = playerid_lookup(last=row["last_name"].strip(), first=row[" first_name"].strip(), fuzzy=False)
-            if len(lookup) == 0:
-                lookup = playerid_lookup(last=row["last_name"].strip(), first=row[" first_name"].strip(), fuzzy=True)
-            lookup = lookup[lookup.key_mlbam != -1]
-            if len(lookup) > 0:
-                active_spin.loc[((active_spin['last_name'] == row["last_name"]) & (
-                            active_spin[' first_name'] == row[" first_name"])), "player_id"] = lookup.iloc[0][
-                    "key_mlbam"]
-            else:
-                log.error("Couldn't find MLB ID for {} {}".format(row[" first_name"], row["last_name"]))
-        else:
-            print("Skipping")
+    ids = name_index().resolve(active_spin[" first_name"].str.strip(), active_spin["last_name"].str.strip())
+    active_spin = active_spin.assign(player_id=ids.to_numpy())
 
     unassigned = active_spin[active_spin.player_id == -1]
     log.info("active_spin rows without a player_id: {}".format(len(unassigned)))
-    print("active_spin rows without a player_id")
-    print(unassigned)
+    for _, row in unassigned.drop_duplicates(["last_name", " first_name"]).iterrows():
+        log.error("Couldn't find MLB ID for {} {}".format(row[" first_name"], row["last_name"]))
     active_spin = active_spin[active_spin.player_id != -1]
 
-    with open(cache_movement_path, "wb") as cm, open(cache_spin_path, "wb") as cs:
-        pickle.dump(movement, cm), pickle.dump(active_spin, cs)
-
     return movement, active_spin
 
 
 def map_fangraph_id(fangraph):
     log.info("Merging fangraphs data")
-    chad = chadwick_register()
-    chad_columns = list(chad.columns)
-    chad_columns.remove("key_mlbam")
-    fangraph = pd.merge(left=chad, right=fangraph, left_on="key_fangraphs", right_on="IDfg")
-    fangraph = fangraph.drop(chad_columns, axis=1)
-    return fangraph.rename(columns={"key_mlbam": "player_id"})
+    player_id = get_crosswalk().map(fangraph.IDfg, "key_fangraphs", "key_mlbam")
+    # Rows whose Fangraphs id isn't in the register are dropped, as the inner merge on the register did
+    fangraph = fangraph.assign(player_id=player_id)
+    fangraph = fangraph[fangraph.player_id != -1]
+    return fangraph[["player_id"] + [c for c in fangraph.columns if c != "player_id"]]
 
 
 def agg_pitchers(pitcher, pitches):
-
     # Roll up the pitch-by-pitch data in the pitcher table into aggregated statistics
     log.info("Aggregating stats for pitcher table")
-    to_keep = ["release_spin_rate", "effective_speed", "spin_axis", "release_speed", "pfx_x", "pfx_z", "plate_x", "plate_z"]
-    pitcher = pitcher.dropna(subset=to_keep)
-
-    # Map zones to "strike_high", "strike_middle", "strike_low", "ball_high", "ball_low"
-    merged_zones = ["strike_high", "strike_middle", "strike_low", "ball_high", "ball_low"]
-    pitcher = pitcher.dropna(subset=["zone"])
-    pitcher["merged_zone"] = pd.NA
-
-    pitcher.loc[pitcher.zone == 11, "merged_zone"] = "ball_high"
-    pitcher.loc[pitcher.zone == 12, "merged_zone"] = "ball_high"
-
-    pitcher.loc[pitcher.zone == 1, "merged_zone"] = "strike_high"
-    pitcher.loc[pitcher.zone == 2, "merged_zone"] = "strike_high"
-    pitcher.loc[pitcher.zone == 3, "merged_zone"] = "strike_high"
-
-    pitcher.loc[pitcher.zone == 4, "merged_zone"] = "strike_middle"
-    pitcher.loc[pitcher.zone == 5, "merged_zone"] = "strike_middle"
-    pitcher.loc[pitcher.zone == 6, "merged_zone"] = "strike_middle"
-
-    pitcher.loc[pitcher.zone == 7, "merged_zone"] = "strike_low"
-    pitcher.loc[pitcher.zone == 8, "merged_zone"] = "strike_low"
-    pitcher.loc[pitcher.zone == 9, "merged_zone"] = "strike_low"
-
-    pitcher.loc[pitcher.zone == 13, "merged_zone"] = "ball_low"
-    pitcher.loc[pitcher.zone == 14, "merged_zone"] = "ball_low"
-
-    columns = ["player_id", "year"]
-    for pitch in pitches:
-        for column in to_keep:
-            columns.append(pitch + "_" + column + "_mean")
-            columns.append(pitch + "_" + column + "_std")
-        for zone in merged_zones:
-            columns.append(pitch + "_" + zone)
-
-    rows = []
-    for player_id in pd.unique(pitcher.pitcher):
-        player = pitcher[pitcher.pitcher == player_id]
-        for year in pd.unique(player.year):
-            player_year = player[player.year == year]
-            row = [player_id, year]
-            for pitch in pitches:
-                player_pitch = player_year[player_year.pitch_type == pitch]
-                if len(player_pitch) > 0:
-                    for column in to_keep:
-                        row.append(np.mean(player_pitch[column]))
-                        row.append(np.std(player_pitch[column]))
-                    zone_count = player_pitch['merged_zone'].value_counts()
-                    for merged_zone in merged_zones:
-                        if merged_zone in zone_count:
-                            row.append(zone_count[merged_zone] / len(player_pitch))
-                        else:
-                            row.append(0.0)
-                else:
-                    row.extend([np.nan] * (len(to_keep) * 2))
-                    row.extend([np.nan] * len(merged_zones))
-            rows.append(row)
-
-    log.info("Creating aggregated dataframe")
-    return pd.DataFrame(rows, columns=columns).replace(pd.NA, np.nan)
+    return PitchState(pitches=pitches).fold(pitcher).emit()
 
 
 def agg_movement(movement, pitches):
@@ -265,25 +242,65 @@ def split(merged):
     return None
 
 
-def main():
-    pitcher, fangraph = load_dataframes()
-    pitcher = clean_pitches(pitcher)
-    pitches = pd.unique(pitcher.pitch_type)
-    pitcher = lefty(pitcher)
-    # active_spin = rename_spin(active_spin)
-    fangraph = map_fangraph_id(fangraph)
-    # movement, active_spin = map_player_ids(movement, active_spin)
-    pitcher = agg_pitchers(pitcher, pitches)
-    # movement = agg_movement(movement, pitches)
-    merged = merge(pitcher, fangraph)
-    merged = clean(merged)
+def main(incremental=False, workers=None):
+    # Incremental runs fold only the pitches since the saved state's watermark into it. Full runs start a new state.
+    state = PitchState.load() if incremental else None
+    if state is None:
+        state = PitchState()
+    else:
+        log.info("Folding pitches after {} into the saved state".format(state.watermark))
+    with stage("create_data.load", incremental=incremental) as s:
+        fangraph = load_dataframes()
+        s.add("rows_out", len(fangraph))
+    with stage("create_data.aggregate", workers=workers) as s:
+        # Seasons are aggregated in parallel and merged in year order, so the state comes out the same as folding
+        # them one after another
+        since = state.watermark
+        years = list(pitch_years(since))
+        pool = ProcessPoolExecutor(max_workers=workers) if workers != 1 else None
+        folded = map(fold_season, years, [since] * len(years)) if pool is None else \
+            pool.map(fold_season, years, [since] * len(years))
+        held = []
+        for year, (season, today, rows) in zip(years, folded):
+            held.append((state.rows, today))
+            state.merge(season)
+            s.add("rows_in", rows)
+            log.info("Folded {} pitches from {}".format(rows, year))
+        if pool is not None:
+            pool.shutdown()
+        state.save()
+        # Today's games count towards a full run's features but aren't in the saved state, an incremental run folds
+        # them in once they're over
+        for shift, today in held:
+            state.merge(today, shift)
+        pitcher = state.emit()
+        # movement = agg_movement(movement, pitches)
+        s.add("rows_out", len(pitcher))
+    with stage("create_data.map_ids") as s:
+        s.add("rows_in", len(fangraph))
+        # active_spin = rename_spin(active_spin)
+        fangraph = map_fangraph_id(fangraph)
+        # movement, active_spin = map_player_ids(movement, active_spin)
+        s.add("rows_out", len(fangraph))
+    with stage("create_data.merge") as s:
+        merged = merge(pitcher, fangraph)
+        merged = clean(merged)
+        s.add("rows_out", len(merged))
 
     tmp = split(merged)
 
     log.info("Saving dataframe")
-    with open(join("learning", "build", "build/combined.pkl"), "wb") as f:
-        pickle.dump(merged, f)
+    with stage("create_data.save") as s:
+        path = join("learning", "build", "build/combined.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(merged, f)
+        s.add("bytes_written", getsize(path))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true",
+                        help="Fold only new pitches into the saved aggregate state instead of rebuilding it")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, 1 aggregates in this process")
+    args = parser.parse_args()
+    main(incremental=args.incremental, workers=args.workers)
@@ -10,6 +10,7 @@ from sklearn.preprocessing import PowerTransformer
 from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
 
 from logging_config import log
+from metrics import Progress, progress, stage
 
 
 def importance(x, y, classification=True, estimators=[], scoring=None,
@@ -40,6 +41,8 @@ def importance(x, y, classification=True, estimators=[], scoring=None,
 
     # Keep running the data through RFECV until we hit max iterations or the change is below a threshold
     log.info("RFECV")
+    # Convergence usually stops this early, so the ETA is an upper bound
+    rfe_progress = Progress("RFECV", rfe_max_iter)
     for i in range(1, rfe_max_iter + 1):
         tmp_scores = np.zeros(scores.shape, dtype=float)
         for e in estimators:
@@ -54,6 +57,7 @@ def importance(x, y, classification=True, estimators=[], scoring=None,
         diff = np.sum(np.abs(scores - new))
         log.info("\t{} -> Diff: {}".format(i, diff))
         scores = new
+        rfe_progress.update()
         if diff < rfe_thresh and i >= rfe_min_iter:
             break
 
@@ -62,7 +66,7 @@ def importance(x, y, classification=True, estimators=[], scoring=None,
     running_columns = []
     col_scores = []
     log.info("Estimator")
-    for column in fe_columns:
+    for column in progress(fe_columns, "Estimator"):
         log.info(column)
         running_columns.append(column)
         col_score = 0
@@ -126,7 +130,9 @@ def main():
     x = pd.DataFrame(PowerTransformer().fit_transform(master_df[columns].fillna(0)), columns=columns)
     y = master_df['xFIP']
 
-    results = importance(x, y, classification=False, rfe_thresh=0.01, est_thresh=0.01)
+    with stage("feature_selection", features=len(columns)) as s:
+        s.add("rows_in", len(x))
+        results = importance(x, y, classification=False, rfe_thresh=0.01, est_thresh=0.01)
     with open(join("learning", "build", "importance_results.pkl"), "wb") as f:
         pickle.dump(results, f)
 
@@ -18,6 +18,7 @@ import warnings
 from sklearn.exceptions import DataConversionWarning
 from learning.custom_learners import DTAdaBoost, SVCAdaBoost, MLPClassWrapper, VotingAdaBoost, MSDVotingClassifier
 from logging_config import log
+from metrics import Progress, stage
 
 
 def frange(start=0, end=1, step=0.1):
@@ -117,12 +118,17 @@ def main():
 
     scores = dict(zip(learners.keys(), [(-float("inf"), None)] * len(learners.keys())))
 
-    for c in range(3):
+    rounds = 3
+    search_progress = Progress("Grid search", rounds * len(learners), every=0)
+    for c in range(rounds):
         log.info(c)
         for learner, params in learners.items():
             score, best_params = scores[learner]
-            gs = GridSearchCV(estimator=learner, param_grid=params, scoring="neg_mean_absolute_error", cv=5, n_jobs=-1)
-            gs.fit(x, y)
+            with stage("grid_search", learner=learner.__class__.__name__, round=c) as s:
+                s.add("rows_in", len(x))
+                gs = GridSearchCV(estimator=learner, param_grid=params, scoring="neg_mean_absolute_error", cv=5, n_jobs=-1)
+                gs.fit(x, y)
+            search_progress.update()
             if gs.best_score_ > score:
                 log.info("{}, {}, {}, {}".format(learner, "Best Score", gs.best_score_, gs.best_params_))
                 scores[learner] = (gs.best_score_, gs.best_params_)
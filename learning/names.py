@@ -0,0 +1,73 @@
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from crosswalk import get_crosswalk
+from logging_config import log
+
+# Names without an exact match are compared against the register names sharing the most trigrams with them, and
+# the most similar one is taken if its difflib ratio is above the cutoff
+FUZZY_CANDIDATES = 20
+FUZZY_CUTOFF = 0.8
+
+
+def normalize_names(names):
+    # "José  O'Neil-Smith Jr." -> "jose oneilsmith jr": accents, case, punctuation and extra spaces don't matter
+    return names.fillna("").astype(str).str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii") \
+        .str.lower().str.replace(r"[^a-z ]", "", regex=True).str.split().str.join(" ")
+
+
+def trigrams(name):
+    padded = "  " + name + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    # Resolves "first last" names to MLBAM ids. Exact matches on the normalized name are one hash join over all the
+    # rows, the few names left over are matched on shared trigrams and then edit similarity.
+
+    def __init__(self, register):
+        names = normalize_names(register.name_first.fillna("") + " " + register.name_last.fillna(""))
+        ids = register.key_mlbam.fillna(-1).astype("int64").to_numpy()
+        # A name maps to its first register row with an MLBAM id. Names only known without one map to -1, the way
+        # playerid_lookup finds them but has no id to give.
+        order = np.argsort(ids == -1, kind="stable")
+        by_name = pd.Series(ids[order], index=names.to_numpy()[order])
+        self.exact = by_name[~by_name.index.duplicated()]
+
+        # Only names with an id can be fuzzy matches
+        self.names = self.exact[self.exact != -1].index.to_numpy()
+        self.grams = defaultdict(list)
+        for i, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.grams[gram].append(i)
+
+    def closest(self, name):
+        shared = Counter()
+        for gram in trigrams(name):
+            shared.update(self.grams.get(gram, ()))
+        best, best_ratio = None, FUZZY_CUTOFF
+        for i, _ in shared.most_common(FUZZY_CANDIDATES):
+            ratio = SequenceMatcher(None, name, self.names[i]).ratio()
+            if ratio > best_ratio or (ratio == best_ratio and best is None):
+                best, best_ratio = self.names[i], ratio
+        return None if best is None else self.exact[best]
+
+    def resolve(self, first, last):
+        # MLBAM id per row, -1 where the name couldn't be resolved
+        names = normalize_names(first.fillna("") + " " + last.fillna(""))
+        ids = names.map(self.exact)
+        missing = ids.isna().to_numpy()
+        if missing.any():
+            fuzzy = {name: self.closest(name) for name in pd.unique(names[missing])}
+            log.info("Fuzzy matched {} of {} names without an exact match".format(
+                sum(v is not None for v in fuzzy.values()), len(fuzzy)))
+            ids[missing] = names[missing].map(fuzzy)
+        return ids.fillna(-1).astype("int64")
+
+
+@lru_cache(maxsize=None)
+def name_index():
+    return NameIndex(get_crosswalk().table)
@@ -3,12 +3,12 @@ from os.path import join
 
 import numpy as np
 import pandas as pd
-import pybaseball
 from sklearn.preprocessing import PowerTransformer
 from sklearn.metrics import accuracy_score, mean_squared_error
 from sklearn.svm import LinearSVC, SVR
 from sklearn.tree import DecisionTreeClassifier
 
+from crosswalk import get_crosswalk
 from learning.custom_learners import VotingAdaBoost, DTAdaBoost, MSDVotingClassifier, SVCAdaBoost
 
 
@@ -66,7 +66,11 @@ def main():
     master_df[["tercile", "pred_tercile", "xFIP", "pred_xFIP"]] = test[["tercile", "pred_tercile", "xFIP", "pred_xFIP"]]
     master_df["diff"] = master_df["xFIP"] - master_df["pred_xFIP"]
 
-    final = pd.merge(master_df, pybaseball.chadwick_register(), left_on=['player_id'], right_on=['key_mlbam'])
+    # Players missing from the register are dropped, as the merge with it did
+    crosswalk = get_crosswalk()
+    found = crosswalk.rows(master_df.player_id, "key_mlbam") != -1
+    names = crosswalk.names(master_df.player_id)
+    final = master_df.assign(name_first=names.name_first.to_numpy(), name_last=names.name_last.to_numpy())[found]
     final[["year", "player_id", "name_first", "name_last", "tercile", "pred_tercile", "pred_xFIP", "xFIP", "diff"]].dropna(subset=["pred_xFIP"]).to_csv("final.csv")
 
 
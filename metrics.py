@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from logging_config import log
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Every stage and request appends one JSON line here, next to log.txt
+METRICS = "metrics.jsonl"
+RUN = "{}-{}".format(int(time.time()), os.getpid())
+COUNTERS = ["rows_in", "rows_out", "bytes_read", "bytes_written", "cache_hits", "cache_misses"]
+lock = threading.Lock()
+
+
+def peak_rss():
+    # High-water resident set size in bytes of this process and of its finished children, such as pool workers
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def cpu_time():
+    # Includes the CPU time of worker processes that have been joined
+    if resource is None:
+        return time.process_time()
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def record(kind, **fields):
+    line = json.dumps(dict(fields, kind=kind, run=RUN, at=time.time()), default=str)
+    with lock:
+        with open(METRICS, "a") as f:
+            f.write(line + "\n")
+
+
+class Stage:
+    # Counters for one stage, safe to add to from several threads
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+
+@contextmanager
+def stage(name, **tags):
+    # Times a pipeline step and writes its wall time, CPU time, peak RSS and counters when it ends, even on error
+    s = Stage(name, tags)
+    started, cpu = time.perf_counter(), cpu_time()
+    status = "error"
+    try:
+        yield s
+        status = "ok"
+    finally:
+        wall = time.perf_counter() - started
+        record("stage", stage=name, tags=tags, status=status, wall=wall, cpu=cpu_time() - cpu, peak_rss=peak_rss(),
+               **s.counters)
+        log.info("Stage {} {} in {:.1f}s".format(name, status, wall))
+
+
+class Progress:
+    # Logs how far a long loop has got, at most every "every" seconds, with an ETA when the total is known
+
+    def __init__(self, name, total=None, every=30):
+        self.name = name
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.started = self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if now - self.last < self.every and self.done != self.total:
+                return
+            self.last = now
+        log.info(self.message(now))
+
+    def message(self, now):
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if self.total is None:
+            return "{}: {} done ({:.2f}/s)".format(self.name, self.done, rate)
+        eta = (self.total - self.done) / rate if rate > 0 else float("inf")
+        return "{}: {}/{} ({:.0%}, {:.2f}/s, ETA {:.0f}s)".format(
+            self.name, self.done, self.total, self.done / self.total if self.total > 0 else 1.0, rate, eta)
+
+
+def progress(iterable, name, total=None, every=30):
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+    p = Progress(name, total, every)
+    for item in iterable:
+        yield item
+        p.update()
+
+
+def load(path=METRICS, run=None):
+    # run is a run id, "latest" or None for every run
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if run == "latest" and len(records) > 0:
+        run = records[-1]["run"]
+    return [r for r in records if run is None or r["run"] == run]
+
+
+def summary(path=METRICS, run="latest"):
+    # One line per stage name: how often it ran and its totals, plus per-method request counts
+    stages = {}
+    requests = {}
+    for r in load(path, run):
+        if r["kind"] == "stage":
+            s = stages.setdefault(r["stage"], dict(dict.fromkeys(COUNTERS, 0), runs=0, wall=0.0, cpu=0.0, peak_rss=0))
+            s["runs"] += 1
+            s["wall"] += r["wall"]
+            s["cpu"] += r["cpu"]
+            s["peak_rss"] = max(s["peak_rss"], r["peak_rss"] or 0)
+            for counter in COUNTERS:
+                s[counter] += r.get(counter, 0)
+        elif r["kind"] == "request":
+            q = requests.setdefault(r["method"], {"requests": 0, "wall": 0.0, "rows": 0, "cache_hits": 0, "failed": 0})
+            q["requests"] += 1
+            q["wall"] += r["wall"]
+            q["rows"] += r.get("rows") or 0
+            q["cache_hits"] += int(r.get("cache") == "hit")
+            q["failed"] += int(r.get("status") != "ok")
+
+    lines = ["{:32} {:>5} {:>10} {:>10} {:>12} {:>12} {:>14} {:>14} {:>8} {:>10}".format(
+        "stage", "runs", "wall s", "cpu s", "rows in", "rows out", "bytes read", "bytes written", "hits", "peak MB")]
+    for name, s in sorted(stages.items(), key=lambda item: -item[1]["wall"]):
+        lines.append("{:32} {:>5} {:>10.1f} {:>10.1f} {:>12} {:>12} {:>14} {:>14} {:>8} {:>10.0f}".format(
+            name, s["runs"], s["wall"], s["cpu"], s["rows_in"], s["rows_out"], s["bytes_read"], s["bytes_written"],
+            s["cache_hits"], s["peak_rss"] / 2 ** 20))
+    if len(requests) > 0:
+        lines.append("")
+        lines.append("{:45} {:>8} {:>10} {:>10} {:>12} {:>8} {:>8}".format(
+            "method", "requests", "wall s", "mean s", "rows", "hits", "failed"))
+        for method, q in sorted(requests.items(), key=lambda item: -item[1]["wall"]):
+            lines.append("{:45} {:>8} {:>10.1f} {:>10.2f} {:>12} {:>8} {:>8}".format(
+                method, q["requests"], q["wall"], q["wall"] / q["requests"], q["rows"], q["cache_hits"], q["failed"]))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the stage and request metrics of a pipeline run")
+    parser.add_argument("--run", default="latest", help="Run id to summarize, \"latest\" or \"all\"")
+    parser.add_argument("--path", default=METRICS)
+    args = parser.parse_args()
+    print(summary(args.path, None if args.run == "all" else args.run))
@@ -40,7 +40,6 @@ from os.path import join
 import numpy as np
 import pandas as pd
 from numpy import count_nonzero
-from pybaseball import chadwick_register
 
 # with open("data/build/statcast_pitcher.pkl", "rb") as f:
 #     pitcher = pickle.load(f)
@@ -51,7 +50,7 @@ from pybaseball import chadwick_register
 # print("Lefty Mean", np.mean(lefty.loc[lefty.pitch_type == "FC", "plate_x"]))
 # print("Righty Mean", np.mean(righty.loc[righty.pitch_type == "FC", "plate_x"]))
 
-# chad = chadwick_register()
+# chad = get_crosswalk().register()
 #
 # pd.merge(left=chad, right=df, left_on="key_fangraphs", right_on="IDfg")
 #